@@ -34,13 +34,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 修改作者：XY2006DATE
 """
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context, g, has_app_context
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import os
 import json
 import asyncio
 import aiohttp
 import aiofiles
-from threading import Thread
+import threading
+from threading import Thread, Lock
 from queue import Queue
 import time
 from typing import Optional, Dict, List
@@ -49,15 +51,41 @@ import bs4
 import re
 import random
 import urllib3
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
 from tqdm import tqdm
-from fake_useragent import UserAgent
+try:
+    from fake_useragent import UserAgent
+except ImportError:
+    UserAgent = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 import base64
 import gzip
-from urllib.parse import urlencode
+import hashlib
+import shutil
+import io
+import zipfile
+import mmap
+import struct
+import socket
+import sqlite3
+from contextlib import contextmanager, asynccontextmanager
+from collections import deque, OrderedDict
+import heapq
+import bisect
+import itertools
+from urllib.parse import urlencode, quote, urlsplit
+from html import unescape, escape
 import logging
 from logging.handlers import RotatingFileHandler
 
@@ -85,12 +113,97 @@ app = Flask(__name__)
 
 # 全局配置
 CONFIG = {
-    "max_workers": 20,  # 增加并发数
+    "max_workers": 20,  # 同时在途的分组请求数
+    "write_buffer_size": 256 * 1024,  # 写缓冲区大小（字节）
+    "fsync_interval": 200,  # 每写入多少章同步一次磁盘
+    "progress_interval": 0.5,  # 任务进度写入存储的最小间隔（秒）
+    "task_db": os.path.join("data", "tasks.db"),  # 任务状态数据库
+    "events": {
+        "min_interval": 0.5,  # 同一连接两次推送的最小间隔（秒），期间的变化合并为一次
+        "poll_interval": 1.0,  # 任务监视器在没有本进程通知时重新读取任务状态和章节清单的间隔（秒），用于发现其他进程的更新
+        "keepalive": 15,  # 状态不变时发送心跳注释的间隔（秒）
+        "max_duration": 600  # 单个连接的最长保持时间（秒），之后由浏览器自动重连
+    },
+    "scheduler": {
+        "max_active_jobs": 4,  # 每个进程同时运行的下载任务数
+        "max_inflight_requests": 40,  # 每个进程同时在途的上游请求数，由运行中的任务轮流分配
+        "priorities": {"update": 0, "full": 1}  # 数值越小越先执行
+    },
+    "batch": {
+        "concurrency": 8,  # 批量下载时同时进入调度队列的书籍数，实际同时运行的数量受 scheduler.max_active_jobs 限制
+        "max_books": 1000,  # 单次批量提交的书籍数上限
+        "report_dir": os.path.join("data", "batches")  # 批量下载完成后写出的汇总报告目录
+    },
+    "stream": {
+        "chunk_size": 64 * 1024
+    },
     "max_retries": 3,
     "request_timeout": 15,
     "status_file": "chapter.json",
-    "request_rate_limit": 0,  # 降低请求间隔
-    "chunk_size": 20,  # 每批处理的章节数
+    "request_rate_limit": 0,  # 每个上游端点每秒请求数上限，0 表示只按自适应限速
+    "batch_size": 30,  # 官方接口单次批量获取的章节数
+    "register_key_ttl": 1800,  # 解密密钥缓存有效期（秒）
+    "connection_pool": {
+        "limit": 100,  # 连接池总连接数
+        "limit_per_host": 30,  # 单个主机的最大连接数
+        "keepalive_timeout": 60,  # 空闲连接保持时间（秒）
+        "ttl_dns_cache": 300  # DNS 缓存时间（秒）
+    },
+    "upstream": {
+        "initial_rate": 50,  # 每个端点初始每秒请求数
+        "min_rate": 1,
+        "max_rate": 1000,
+        "burst": 20,  # 令牌桶容量
+        "increase": 2,  # 持续成功时速率每秒约增加的值（加性增）
+        "decrease_factor": 0.5,  # 被限流或超出延迟目标时速率乘以该系数（乘性减）
+        "decrease_interval": 1.0,  # 两次降速之间的最小间隔（秒）
+        "latency_target": 5.0,  # 超过该延迟（秒）的成功请求也视为拥塞信号
+        "backoff_base": 0.5,  # 重试退避基数（秒）
+        "backoff_max": 8.0,
+        "failure_threshold": 5,  # 连续失败多少次后熔断
+        "open_seconds": 30,  # 熔断后多久放行一次探测请求
+        "health_window": 100  # 统计成功率和延迟分位数的最近请求数
+    },
+    "fallback": {
+        "hedge": True,  # 备用接口响应慢时并发请求下一个接口，取先返回的有效结果
+        "hedge_percentile": 0.95,  # 等待当前接口的延迟分位数后发起对冲请求
+        "hedge_min_delay": 0.2,  # 对冲等待时间下限（秒）
+        "hedge_default_delay": 1.0,  # 样本不足时的对冲等待时间（秒）
+        "min_samples": 10
+    },
+    "cpu_pool": {
+        "kind": "thread",  # thread 或 process；process 可绕开 GIL，但每个进程会额外启动工作进程
+        "workers": 0  # 工作线程/进程数，0 表示 CPU 核数
+    },
+    "chapter_cache": {
+        "enabled": True,
+        "dir": os.path.join("cache", "chapters"),
+        "max_bytes": 512 * 1024 * 1024,  # 缓存总大小上限
+        "ttl": 0  # 缓存有效期（秒），0 表示不过期
+    },
+    "headers": {
+        "rotation": "session",  # session：每个下载任务固定一个 User-Agent；request：每个请求轮换
+        "browsers": ["chrome", "edge"],
+        "pool_size": 50,  # 首次使用时从 fake_useragent 取样的 User-Agent 数量
+        "use_fake_useragent": True  # 关闭或加载失败时只使用内置列表
+    },
+    "compression": {
+        "encodings": ["br", "zstd", "gzip"],  # 完成时生成的预压缩副本，按顺序作为同等权重时的优先级；未安装的模块自动跳过
+        "gzip_level": 9,
+        "zstd_level": 19,
+        "brotli_quality": 11
+    },
+    "chapter_index": {
+        "max_range": 500,  # 单次最多读取的章节数
+        "cache_size": 64  # 每个进程保持映射的索引文件数
+    },
+    "metrics": {
+        "enabled": True,
+        "flush_interval": 5.0,  # 各进程把指标快照写入任务数据库的间隔（秒），/metrics 汇总所有进程
+        "buckets": [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]  # 耗时直方图的桶上界（秒）
+    },
+    "book_info_ttl": 86400,  # 书籍信息缓存有效期（秒），期间重复或继续下载不再请求书籍页面
+    "web_base_url": "https://fanqienovel.com",
     "api_endpoints": [
         "https://api.cenguigui.cn/api/tomato/content.php?item_id={chapter_id}",
         "https://lsjk.zyii.xyz:3666/content?item_id={chapter_id}"
@@ -99,40 +212,535 @@ CONFIG = {
         "install_id": "4427064614339001",
         "server_device_id": "4427064614334905",
         "aid": "1967",
-        "update_version_code": "62532"
+        "update_version_code": "62532",
+        "base_url": "https://api5-normal-sinfonlineb.fqnovel.com"
     }
 }
 
-# 下载任务队列
-download_tasks = {}
-download_controls = {}  # 用于控制下载任务
-download_progress = {}  # 用于存储下载进度
+# 官方 batch_full 接口单次请求的章节数上限
+OFFICIAL_BATCH_LIMIT = 30
+
+class ChangeNotifier:
+    """进程内的变更版本号，任务监视器据此在本进程有更新时尽快重新读取"""
+
+    def __init__(self, tick: float = 0.25):
+        self.version = 0
+        self.tick = tick
+
+    def notify(self):
+        self.version += 1
+
+    def wait(self, version: int, timeout: float) -> int:
+        """等待版本号变化或超时，返回当前版本号；只用 time.sleep，在 gevent 工作进程中也不会阻塞其他连接"""
+        deadline = time.monotonic() + timeout
+        while self.version == version and time.monotonic() < deadline:
+            time.sleep(self.tick)
+        return self.version
+
+change_notifier = ChangeNotifier()  # 任务状态写入或章节正文写出
+
+class TaskStore:
+    """基于 SQLite（WAL 模式）的任务状态存储，所有工作进程共享同一份任务状态"""
+
+    # 独立成列的字段，其余字段以 JSON 形式存放在 extra 列
+    COLUMNS = ('book_id', 'status', 'mode', 'progress', 'message', 'file_path', 'attached_to',
+               'subscribed', 'stop_requested', 'owner', 'created_at', 'updated_at')
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        # 请求使用的连接池；gevent 工作进程中每个请求是一个协程，按线程缓存会为每个请求新建连接
+        self._pool: List[sqlite3.Connection] = []
+        self._pool_pid = os.getpid()
+        self._pool_lock = Lock()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                book_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                mode TEXT NOT NULL DEFAULT 'full',
+                progress INTEGER NOT NULL DEFAULT 0,
+                message TEXT,
+                file_path TEXT,
+                attached_to TEXT,
+                subscribed INTEGER NOT NULL DEFAULT 1,
+                stop_requested INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                extra TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status);
+            CREATE INDEX IF NOT EXISTS idx_tasks_created_at ON tasks(created_at);
+            CREATE INDEX IF NOT EXISTS idx_tasks_book_status ON tasks(book_id, status);
+            CREATE INDEX IF NOT EXISTS idx_tasks_attached_to ON tasks(attached_to);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS book_info (
+                book_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                author TEXT NOT NULL,
+                description TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS metrics (
+                process TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                snapshot TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        ''')
+
+    POOL_SIZE = 8  # 每个进程保留的空闲连接数
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self) -> sqlite3.Connection:
+        # 请求中从连接池借用，请求结束时由 release_task_db 归还
+        if has_app_context():
+            conns = g.setdefault('task_db', {})
+            if self not in conns:
+                conns[self] = self._acquire()
+            return conns[self]
+        # 后台线程（以及 fork 后的每个进程）使用自己的连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._pool_lock:
+            # fork 前的连接不能在子进程中使用
+            if self._pool_pid != os.getpid():
+                self._pool, self._pool_pid = [], os.getpid()
+            if self._pool:
+                return self._pool.pop()
+        return self._connect()
+
+    def release(self, conn: sqlite3.Connection):
+        """把请求借用的连接放回连接池，池满时关闭"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._pool_lock:
+            if self._pool_pid == os.getpid() and len(self._pool) < self.POOL_SIZE:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """写事务，BEGIN IMMEDIATE 保证跨进程的读-改-写互斥"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        change_notifier.notify()
+
+    @staticmethod
+    def _to_task(row: sqlite3.Row) -> dict:
+        task = json.loads(row['extra'])
+        for key in row.keys():
+            if key != 'extra' and row[key] is not None:
+                task[key] = row[key]
+        task['subscribed'] = bool(task.get('subscribed'))
+        task['stop_requested'] = bool(task.get('stop_requested'))
+        return task
+
+    def create(self, task_id: str, book_id: str, mode: str, message: str, conn: Optional[sqlite3.Connection] = None):
+        now = time.time()
+        (conn or self._conn()).execute(
+            'INSERT INTO tasks (task_id, book_id, status, mode, message, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (task_id, book_id, 'running', mode, message, now, now)
+        )
+
+    def get(self, task_id: str, conn: Optional[sqlite3.Connection] = None) -> Optional[dict]:
+        row = (conn or self._conn()).execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return self._to_task(row) if row else None
+
+    def update(self, task_id: str, conn: Optional[sqlite3.Connection] = None, **fields):
+        """更新任务字段，未独立成列的字段合并进 extra"""
+        conn = conn or self._conn()
+        columns = {key: value for key, value in fields.items() if key in self.COLUMNS}
+        extra = {key: value for key, value in fields.items() if key not in self.COLUMNS}
+        columns['updated_at'] = time.time()
+        assignments = ', '.join(f'{key} = ?' for key in columns)
+        params = list(columns.values())
+        if extra:
+            assignments += ', extra = json_patch(extra, ?)'
+            params.append(json.dumps(extra, ensure_ascii=False))
+        conn.execute(f'UPDATE tasks SET {assignments} WHERE task_id = ?', params + [task_id])
+        if not conn.in_transaction:
+            change_notifier.notify()
+
+    def delete(self, task_id: str):
+        self._conn().execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+
+    def find_running_job(self, book_id: str, conn: Optional[sqlite3.Connection] = None) -> Optional[dict]:
+        """查找某本书正在排队或运行的主任务"""
+        rows = (conn or self._conn()).execute(
+            "SELECT * FROM tasks WHERE book_id = ? AND status IN ('queued', 'running') AND attached_to IS NULL "
+            "AND owner IS NOT NULL ORDER BY created_at",
+            (book_id,)
+        ).fetchall()
+        for row in rows:
+            if owner_alive(row['owner']):
+                return self._to_task(row)
+        return None
+
+    def count_subscribers(self, job_id: str, conn: Optional[sqlite3.Connection] = None) -> int:
+        return (conn or self._conn()).execute(
+            'SELECT COUNT(*) FROM tasks WHERE (task_id = ? OR attached_to = ?) AND subscribed = 1',
+            (job_id, job_id)
+        ).fetchone()[0]
+
+    def is_stop_requested(self, job_id: str) -> bool:
+        row = self._conn().execute('SELECT stop_requested FROM tasks WHERE task_id = ?', (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def list_batch(self, batch_id: str) -> List[dict]:
+        rows = self._conn().execute(
+            "SELECT * FROM tasks WHERE json_extract(extra, '$.batch_id') = ? ORDER BY task_id",
+            (batch_id,)
+        ).fetchall()
+        return [self._to_task(row) for row in rows]
+
+    def list_expired(self, before: float) -> List[dict]:
+        # 已停止的任务按最后一次更新计算；合并的任务在主任务结束或已删除后过期；主任务按最近一次合并的时间计算，合并的任务还在使用它的文件
+        rows = self._conn().execute(
+            """
+            SELECT t.* FROM tasks t LEFT JOIN tasks j ON j.task_id = t.attached_to
+            WHERE (t.status = 'stopped' AND t.updated_at < ? OR t.status != 'stopped' AND t.created_at < ?) AND (
+                (t.attached_to IS NULL AND t.status IN ('completed', 'error', 'stopped')
+                 AND NOT EXISTS (SELECT 1 FROM tasks a WHERE a.attached_to = t.task_id AND a.created_at >= ?))
+                OR (t.attached_to IS NOT NULL AND (j.task_id IS NULL OR j.status IN ('completed', 'error', 'stopped')))
+            )
+            """,
+            (before, before, before)
+        ).fetchall()
+        return [self._to_task(row) for row in rows]
+
+    def file_in_use(self, file_path: str, excluded: List[str]) -> bool:
+        """除 excluded 以外是否还有任务使用这个文件（同一本书的多次下载写入同一路径）"""
+        placeholders = ', '.join('?' * len(excluded))
+        row = self._conn().execute(
+            f'SELECT 1 FROM tasks WHERE file_path = ? AND task_id NOT IN ({placeholders}) LIMIT 1',
+            [file_path] + excluded
+        ).fetchone()
+        return row is not None
+
+    def claim(self, key: str, interval: float) -> bool:
+        """多个进程中只有一个能在 interval 内领取到同一项周期性工作"""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+            if row and now - row[0] < interval:
+                return False
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, now))
+            return True
+
+    def add_counter(self, key: str, delta: float) -> float:
+        """原子地累加各进程共享的计数，返回累加后的值"""
+        return self._conn().execute(
+            'INSERT INTO meta (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = value + excluded.value RETURNING value',
+            (key, delta)
+        ).fetchone()[0]
+
+    def set_counter(self, key: str, value: float):
+        self._conn().execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def get_book_info(self, book_id: str, max_age: float) -> Optional[tuple]:
+        """读取未过期的书籍信息缓存，返回 (书名, 作者, 简介)"""
+        row = self._conn().execute(
+            'SELECT name, author, description FROM book_info WHERE book_id = ? AND fetched_at >= ?',
+            (book_id, time.time() - max_age)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def put_book_info(self, book_id: str, name: str, author: str, description: str):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO book_info (book_id, name, author, description, fetched_at) VALUES (?, ?, ?, ?, ?)',
+            (book_id, name, author, description, time.time())
+        )
+
+    def put_metrics(self, process: str, owner: str, snapshot: str, conn: Optional[sqlite3.Connection] = None):
+        (conn or self._conn()).execute(
+            'INSERT OR REPLACE INTO metrics (process, owner, snapshot, updated_at) VALUES (?, ?, ?, ?)',
+            (process, owner, snapshot, time.time())
+        )
+
+    def list_metrics(self, conn: Optional[sqlite3.Connection] = None) -> List[sqlite3.Row]:
+        return (conn or self._conn()).execute('SELECT process, owner, snapshot FROM metrics').fetchall()
+
+    def delete_metrics(self, processes: List[str], conn: Optional[sqlite3.Connection] = None):
+        (conn or self._conn()).executemany('DELETE FROM metrics WHERE process = ?', [(p,) for p in processes])
+
+def get_owner() -> str:
+    """当前进程的标识，用于判断运行中的任务是否还有进程在执行"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def owner_alive(owner: Optional[str]) -> bool:
+    if not owner:
+        return False
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        # 无法检查其他主机上的进程，视为存活
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+task_store = TaskStore(CONFIG["task_db"])
+
+# 导出的指标：名称 -> (类型, 说明)
+METRIC_DEFINITIONS = {
+    'fanqie_stage_seconds': ('histogram', '下载各阶段耗时（秒）：directory、book_info、register_key、batch_get、decrypt、clean、fallback、write'),
+    'fanqie_upstream_request_seconds': ('histogram', '上游单次请求（不含重试等待）耗时（秒）'),
+    'fanqie_upstream_requests_total': ('counter', '上游请求次数，每次重试单独计数，按端点和结果'),
+    'fanqie_upstream_bytes_total': ('counter', '从上游读取的响应体字节数'),
+    'fanqie_chapters_total': ('counter', '取得的章节数，按来源：cache、official、fallback、failed'),
+    'fanqie_chapter_cache_lookups_total': ('counter', '章节缓存查询次数，按结果：hit、miss'),
+    'fanqie_chapter_cache_saved_bytes_total': ('counter', '命中章节缓存而免于下载的正文字节数'),
+    'fanqie_written_bytes_total': ('counter', '写入小说文件的字节数'),
+    'fanqie_downloads_total': ('counter', '结束的下载任务数，按结果'),
+    'fanqie_http_request_seconds': ('histogram', 'HTTP 请求处理耗时（秒），流式响应只计到开始发送'),
+    'fanqie_http_requests_total': ('counter', 'HTTP 请求数，按路由和状态码'),
+    'fanqie_active_jobs': ('gauge', '运行中的下载任务数'),
+    'fanqie_queued_jobs': ('gauge', '排队中的下载任务数'),
+    'fanqie_inflight_requests': ('gauge', '在途的上游分组请求数'),
+    'fanqie_upstream_rate': ('gauge', '上游端点当前的自适应限速（请求/秒），各进程之和'),
+    'fanqie_upstream_circuit_open': ('gauge', '上游端点处于熔断状态的进程数')
+}
+
+class StageTimer:
+    """计时上下文，退出时把耗时记入直方图，可以包住 await"""
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+class Metrics:
+    """进程内的计数器和直方图，热路径上只是加锁后的内存加法；仪表在快照时由 collectors 读取。
+    每个进程定期把快照写入任务数据库，/metrics 汇总所有进程，已退出进程的计数器和直方图并入归档行"""
+
+    ARCHIVED = 'archived'
+
+    def __init__(self, settings: dict):
+        self.enabled = settings["enabled"]
+        self.buckets = tuple(settings["buckets"])
+        self.flush_interval = settings["flush_interval"]
+        self.collectors = []  # 返回 [(名称, 标签元组, 值)] 的仪表采集函数
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # fork 出的工作进程从零开始计数，并启动自己的写出线程
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}  # 键 -> 各桶计数（最后一个为 +Inf）加总和
+        self._process = f"{get_owner()}:{time.time():.3f}"
+        self._flusher = None
+        self._last_snapshot = None
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"写出指标失败: {str(e)}")
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        if self._flusher is None:
+            self._start_flusher()
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+        if self._flusher is None:
+            self._start_flusher()
+
+    def timer(self, name: str, **labels) -> StageTimer:
+        return StageTimer(self, name, labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [[name, labels, value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, labels, list(values)] for (name, labels), values in self._histograms.items()]
+        gauges = []
+        for collector in self.collectors:
+            try:
+                gauges.extend([name, labels, value] for name, labels, value in collector())
+            except Exception as e:
+                logger.error(f"采集指标失败: {str(e)}")
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def flush(self):
+        """把本进程的快照写入任务数据库，内容没有变化时跳过"""
+        snapshot = json.dumps(self.snapshot(), ensure_ascii=False)
+        if snapshot != self._last_snapshot:
+            task_store.put_metrics(self._process, get_owner(), snapshot)
+            self._last_snapshot = snapshot
+
+    @staticmethod
+    def _merge(target: dict, snapshot: dict, gauges: bool):
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            target['counters'][key] = target['counters'].get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = target['histograms'].get(key)
+            if merged is None:
+                target['histograms'][key] = list(values)
+            elif len(merged) == len(values):
+                target['histograms'][key] = [a + b for a, b in zip(merged, values)]
+        if gauges:
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(map(tuple, labels)))
+                target['gauges'][key] = target['gauges'].get(key, 0) + value
+
+    def _archive_dead(self):
+        """把已退出进程的计数器和直方图并入归档行，避免工作进程重启后行数无限增长"""
+        with task_store.transaction() as conn:
+            rows = task_store.list_metrics(conn)
+            dead = [row['process'] for row in rows if row['process'] != self.ARCHIVED and not owner_alive(row['owner'])]
+            if not dead:
+                return
+            merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+            for row in rows:
+                if row['process'] == self.ARCHIVED or row['process'] in dead:
+                    self._merge(merged, json.loads(row['snapshot']), gauges=False)
+            snapshot = {
+                'counters': [[name, labels, value] for (name, labels), value in merged['counters'].items()],
+                'histograms': [[name, labels, values] for (name, labels), values in merged['histograms'].items()],
+                'gauges': []
+            }
+            task_store.put_metrics(self.ARCHIVED, '', json.dumps(snapshot, ensure_ascii=False), conn)
+            task_store.delete_metrics(dead, conn)
+
+    def merged(self) -> dict:
+        """写出本进程快照后汇总所有进程"""
+        self.flush()
+        if task_store.claim('metrics_archive', self.flush_interval):
+            self._archive_dead()
+        merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        for row in task_store.list_metrics():
+            # 仪表只汇总存活的进程，计数器和直方图保留已退出进程的累计值
+            alive = row['process'] != self.ARCHIVED and owner_alive(row['owner'])
+            self._merge(merged, json.loads(row['snapshot']), gauges=alive)
+        return merged
+
+    def totals(self, name: str) -> Dict[tuple, float]:
+        """某个计数器在所有进程中的累计值，按标签元组"""
+        return {labels: value for (key, labels), value in self.merged()['counters'].items() if key == name}
+
+    def collect(self) -> str:
+        """汇总所有进程的指标，输出 Prometheus 文本格式"""
+        merged = self.merged()
+        lines = []
+        for name, (kind, description) in METRIC_DEFINITIONS.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                for (_, labels), values in sorted(item for item in merged['histograms'].items() if item[0][0] == name):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (float('inf'),), values[:-1]):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {values[-1]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+            else:
+                group = merged['counters' if kind == 'counter' else 'gauges']
+                for (_, labels), value in sorted(item for item in group.items() if item[0][0] == name):
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+metrics = Metrics(CONFIG["metrics"])
 
 # 清理过期任务的时间间隔（秒）
 CLEANUP_INTERVAL = 3600  # 1小时
 
 def cleanup_old_tasks():
     """清理过期的下载任务"""
-    current_time = time.time()
-    expired_tasks = []
-    
-    for task_id, task in download_tasks.items():
-        # 如果任务完成超过24小时，则删除
-        if task.get('status') in ['completed', 'error'] and \
-           current_time - task.get('created_at', 0) > 86400:  # 24小时
-            expired_tasks.append(task_id)
-    
-    for task_id in expired_tasks:
-        # 删除任务文件
-        task = download_tasks[task_id]
-        if 'file_path' in task and os.path.exists(task['file_path']):
+    # 多个工作进程中每个周期只由一个进程执行清理
+    if not task_store.claim('cleanup', CLEANUP_INTERVAL / 2):
+        return
+    
+    # 如果任务完成超过24小时，则删除
+    expired = task_store.list_expired(time.time() - 86400)
+    expired_ids = [task['task_id'] for task in expired]
+    for task in expired:
+        # 删除任务文件，合并到其他任务的记录不拥有文件，同一本书之后的下载仍在使用的文件也保留
+        if (not task.get('attached_to') and task.get('file_path') and os.path.exists(task['file_path'])
+                and not task_store.file_in_use(task['file_path'], expired_ids)):
             try:
                 os.remove(task['file_path'])
+                remove_sidecars(task['file_path'])
+                if os.path.exists(task['file_path'] + '.idx'):
+                    os.remove(task['file_path'] + '.idx')
             except Exception as e:
                 logger.error(f"删除文件失败: {str(e)}")
         
         # 删除任务记录
-        del download_tasks[task_id]
+        task_store.delete(task['task_id'])
 
 # 启动清理任务
 def start_cleanup_task():
@@ -188,32 +796,34 @@ class FqVariable:
         self.update_version_code = update_version_code
 
 class FqReq:
-    def __init__(self, var):
+    def __init__(self, var, session: aiohttp.ClientSession):
         self.var = var
-        self.session = requests.Session()
+        self.session = session
 
-    def batch_get(self, item_ids, download=False):
+    async def batch_get(self, item_ids, download=False):
         headers = {
             "Cookie": f"install_id={self.var.install_id}"
         }
-        url = "https://api5-normal-sinfonlineb.fqnovel.com/reading/reader/batch_full/v"
+        url = f"{CONFIG['official_api']['base_url']}/reading/reader/batch_full/v"
+        if not isinstance(item_ids, str):
+            item_ids = ",".join(str(item_id) for item_id in item_ids)
         params = {
             "item_ids": item_ids,
             "req_type": "0" if download else "1",
             "aid": self.var.aid,
             "update_version_code": self.var.update_version_code
         }
-        response = self.session.get(url, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-        ret_arr = response.json()
+        async with self.session.get(url, headers=headers, params=params, ssl=False) as response:
+            response.raise_for_status()
+            ret_arr = await response.json(content_type=None)
         return ret_arr
 
-    def get_register_key(self):
+    async def get_register_key(self):
         headers = {
             "Cookie": f"install_id={self.var.install_id}",
             "Content-Type": "application/json"
         }
-        url = "https://api5-normal-sinfonlineb.fqnovel.com/reading/crypt/registerkey"
+        url = f"{CONFIG['official_api']['base_url']}/reading/crypt/registerkey"
         params = {
             "aid": self.var.aid
         }
@@ -222,131 +832,944 @@ class FqReq:
             "content": crypto.new_register_key_content(self.var.server_device_id, "0"),
             "keyver": 1
         }).encode('utf-8')
-        response = self.session.post(url, headers=headers, params=params, data=payload, verify=False)
-        response.raise_for_status()
-        ret_arr = response.json()
+        async with self.session.post(url, headers=headers, params=params, data=payload, ssl=False) as response:
+            response.raise_for_status()
+            ret_arr = await response.json(content_type=None)
         key_str = ret_arr['data']['key']
         byte_key = crypto.decrypt(base64.b64decode(key_str))
         return byte_key.hex()
 
-    def get_decrypt_contents(self, res_arr):
-        key = self.get_register_key()
-        crypto = FqCrypto(key)
-        for item_id, content in res_arr['data'].items():
-            byte_content = crypto.decrypt(base64.b64decode(content['content']))
-            s = gzip.decompress(byte_content).decode('utf-8')
-            res_arr['data'][item_id]['originContent'] = s
-        return res_arr
+class RegisterKeyManager:
+    """进程内共享的解密密钥缓存"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._crypto = None
+        self._expires_at = 0.0
+        self._lock = None
+
+    async def get_crypto(self, client: FqReq) -> FqCrypto:
+        """获取缓存的解密器，过期后重新请求密钥"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._crypto is None or time.time() >= self._expires_at:
+                with metrics.timer('fanqie_stage_seconds', stage='register_key'):
+                    self._crypto = FqCrypto(await guarded_request('official', client.get_register_key))
+                self._expires_at = time.time() + self.ttl
+            return self._crypto
 
-    def __del__(self):
-        self.session.close()
+    def invalidate(self, crypto: FqCrypto):
+        """解密失败时作废密钥，仅当其仍是当前密钥时生效"""
+        if self._crypto is crypto:
+            self._crypto = None
+
+register_key_manager = RegisterKeyManager(CONFIG["register_key_ttl"])
+
+def get_fq_variable() -> FqVariable:
+    """根据配置生成官方API参数"""
+    return FqVariable(
+        CONFIG["official_api"]["install_id"],
+        CONFIG["official_api"]["server_device_id"],
+        CONFIG["official_api"]["aid"],
+        CONFIG["official_api"]["update_version_code"]
+    )
+
+class CircuitOpenError(Exception):
+    """端点处于熔断状态，请求未发出"""
+
+class EndpointGuard:
+    """单个上游端点的自适应令牌桶限速（AIMD）与熔断器，只在引擎事件循环中使用"""
+
+    def __init__(self, name: str, settings: dict):
+        self.name = name
+        self.label = urlsplit(name).netloc or name  # 指标中使用的端点名称
+        self.settings = settings
+        self.max_rate = settings["max_rate"]
+        if CONFIG["request_rate_limit"] > 0:
+            self.max_rate = min(self.max_rate, CONFIG["request_rate_limit"])
+        self.rate = min(settings["initial_rate"], self.max_rate)
+        self.tokens = float(settings["burst"])
+        self._refilled_at = time.monotonic()
+        self._decreased_at = 0.0
+        self._slow_start = True
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.counters = {'requests': 0, 'success': 0, 'throttled': 0, 'failed': 0, 'rejected': 0, 'retries': 0}
+        self._outcomes = deque(maxlen=settings["health_window"])
+        self._latencies = deque(maxlen=settings["health_window"])
+
+    def _allow(self) -> bool:
+        """熔断器放行判断：打开状态到期后只放行一个探测请求"""
+        if self.state == 'open':
+            if time.monotonic() - self._opened_at < self.settings["open_seconds"]:
+                return False
+            self.state = 'half_open'
+            self._probing = False
+        if self.state == 'half_open':
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    async def acquire(self):
+        """等待令牌，熔断时直接抛出 CircuitOpenError"""
+        if not self._allow():
+            self.counters['rejected'] += 1
+            metrics.inc('fanqie_upstream_requests_total', endpoint=self.label, result='circuit_open')
+            raise CircuitOpenError(f"{self.name} 已熔断")
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.settings["burst"], self.tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.counters['requests'] += 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._decreased_at < self.settings["decrease_interval"]:
+            return
+        self._decreased_at = now
+        self._slow_start = False
+        self.rate = max(self.settings["min_rate"], self.rate * self.settings["decrease_factor"])
+        self.tokens = min(self.tokens, 1.0)
+
+    def record_success(self, latency: float):
+        self.counters['success'] += 1
+        self.failures = 0
+        self.state = 'closed'
+        self._probing = False
+        if latency > self.settings["latency_target"]:
+            self._decrease()
+        else:
+            # 未遇到拥塞前每次成功加一（慢启动），之后按每秒约 increase 线性增长
+            step = 1 if self._slow_start else self.settings["increase"] / self.rate
+            self.rate = min(self.max_rate, self.rate + step)
+
+    def record_failure(self, throttled: bool):
+        """限流只降低速率；5xx、超时和连接错误累计到熔断阈值"""
+        self.counters['throttled' if throttled else 'failed'] += 1
+        self._decrease()
+        if throttled:
+            self._probing = False
+            return
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.settings["failure_threshold"]:
+            if self.state != 'open':
+                logger.error(f"上游端点熔断: {self.name}")
+            self.state = 'open'
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+    def release_probe(self):
+        """探测请求没有得出结论（如非限流类的 4xx）时，允许下一个请求继续探测"""
+        self._probing = False
+
+    def observe(self, ok: bool, latency: float):
+        """记录一次完整调用（含重试）的结果和耗时，用于健康排序和对冲时机"""
+        self._outcomes.append(ok)
+        self._latencies.append(latency)
+
+    def success_rate(self) -> float:
+        """最近窗口内的成功率，按拉普拉斯平滑，没有样本时为 0.5"""
+        return (sum(self._outcomes) + 1) / (len(self._outcomes) + 2)
+
+    def latency_percentile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        if len(self._latencies) < max(1, min_samples):
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        p50, p95 = self.latency_percentile(0.5), self.latency_percentile(0.95)
+        return {
+            'state': self.state,
+            'rate': round(self.rate, 2),
+            'success_rate': round(self.success_rate(), 3),
+            'p50': round(p50, 3) if p50 is not None else None,
+            'p95': round(p95, 3) if p95 is not None else None,
+            **self.counters
+        }
+
+endpoint_guards: Dict[str, EndpointGuard] = {}
+
+def get_endpoint_guard(name: str) -> EndpointGuard:
+    """按端点名称获取（必要时创建）进程内的保护器"""
+    guard = endpoint_guards.get(name)
+    if guard is None:
+        guard = endpoint_guards[name] = EndpointGuard(name, CONFIG["upstream"])
+    return guard
+
+def upstream_endpoint_label(url: str) -> str:
+    """请求地址在指标中对应的端点名称，与 EndpointGuard.label 一致"""
+    netloc = urlsplit(url).netloc
+    return 'official' if netloc == urlsplit(CONFIG["official_api"]["base_url"]).netloc else netloc
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """带完全抖动的指数退避，服务端给出 Retry-After 时以其为下限"""
+    settings = CONFIG["upstream"]
+    delay = random.uniform(0, min(settings["backoff_max"], settings["backoff_base"] * 2 ** attempt))
+    headers = getattr(error, 'headers', None)
+    if headers and headers.get('Retry-After', '').isdigit():
+        delay = max(delay, float(headers['Retry-After']))
+    return delay
+
+def record_upstream(guard: EndpointGuard, result: str, started: float):
+    metrics.inc('fanqie_upstream_requests_total', endpoint=guard.label, result=result)
+    metrics.observe('fanqie_upstream_request_seconds', time.monotonic() - started, endpoint=guard.label)
+
+async def guarded_request(name: str, request_func):
+    """在端点限速与熔断保护下执行请求，遇到限流、5xx、超时或连接错误时退避重试"""
+    guard = get_endpoint_guard(name)
+    attempt = 0
+    while True:
+        await guard.acquire()
+        started = time.monotonic()
+        try:
+            result = await request_func()
+        except aiohttp.ClientResponseError as e:
+            if e.status != 429 and e.status < 500:
+                guard.release_probe()
+                record_upstream(guard, 'client_error', started)
+                raise
+            guard.record_failure(throttled=e.status == 429)
+            record_upstream(guard, 'throttled' if e.status == 429 else 'server_error', started)
+            error = e
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            guard.record_failure(throttled=False)
+            record_upstream(guard, 'timeout' if isinstance(e, asyncio.TimeoutError) else 'connection_error', started)
+            error = e
+        except (Exception, asyncio.CancelledError):
+            guard.release_probe()
+            raise
+        else:
+            guard.record_success(time.monotonic() - started)
+            record_upstream(guard, 'ok', started)
+            return result
+        if attempt >= CONFIG["max_retries"] or guard.state == 'open':
+            raise error
+        guard.counters['retries'] += 1
+        await asyncio.sleep(retry_delay(attempt, error))
+        attempt += 1
+
+class DownloadEngine:
+    """进程内常驻的下载引擎，持有后台事件循环和共享连接池"""
+
+    def __init__(self):
+        self.loop = None
+        self.session = None
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+
+    def start(self):
+        """启动后台事件循环，fork 后的子进程会重新启动自己的引擎"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self.loop = asyncio.new_event_loop()
+            self._thread = Thread(target=self.loop.run_forever, name='download-engine', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            self.session = asyncio.run_coroutine_threadsafe(self._create_session(), self.loop).result()
+
+    async def _create_session(self) -> aiohttp.ClientSession:
+        pool = CONFIG["connection_pool"]
+        connector = aiohttp.TCPConnector(
+            limit=pool["limit"],
+            limit_per_host=pool["limit_per_host"],
+            keepalive_timeout=pool["keepalive_timeout"],
+            ttl_dns_cache=pool["ttl_dns_cache"],
+            ssl=False
+        )
+        # 读取响应体时统计下载字节数
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._label_request)
+        trace.on_response_chunk_received.append(self._count_bytes)
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=CONFIG["request_timeout"]),
+            trace_configs=[trace]
+        )
+
+    @staticmethod
+    async def _label_request(session, context, params):
+        context.endpoint = upstream_endpoint_label(str(params.url))
+
+    @staticmethod
+    async def _count_bytes(session, context, params):
+        metrics.inc('fanqie_upstream_bytes_total', len(params.chunk), endpoint=context.endpoint)
+
+    def submit(self, coro):
+        """将协程调度到引擎的事件循环上，返回 concurrent.futures.Future"""
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """在引擎上执行协程并阻塞等待结果"""
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        """关闭连接池并停止事件循环"""
+        with self._lock:
+            if not self.loop or self._pid != os.getpid():
+                return
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = None
+            self.session = None
+            self._thread = None
+
+    async def _shutdown(self):
+        # 取消仍在进行的后台任务（如生成压缩副本），已提交到 CPU 工作池的压缩会在池关闭时完成
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.session.close()
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception():
+            logger.error(f"下载引擎任务异常: {str(future.exception())}")
+
+download_engine = DownloadEngine()
+
+class RequestBudget:
+    """进程内的上游请求并发配额，有多个任务等待时按任务轮转分配"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters = {}  # 任务ID -> 等待中的 Future 队列，字典顺序即轮转顺序
+
+    async def acquire(self, job_id: str):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(job_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                waiters = self._waiters.get(job_id)
+                if waiters and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._waiters[job_id]
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        while self.in_flight < self.limit and self._waiters:
+            # 取出轮到的任务的第一个等待者，并把该任务移到队尾
+            job_id = next(iter(self._waiters))
+            waiters = self._waiters.pop(job_id)
+            future = waiters.popleft()
+            if waiters:
+                self._waiters[job_id] = waiters
+            if future.cancelled():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, job_id: str):
+        await self.acquire(job_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+class DownloadScheduler:
+    """下载任务调度器：限制同时运行的任务数，按优先级排队，并在任务之间共享请求配额"""
+
+    def __init__(self, max_active_jobs: int, max_inflight_requests: int):
+        self.max_active_jobs = max_active_jobs
+        self.budget = RequestBudget(max_inflight_requests)
+        self._queue = []  # (优先级, 序号, 任务ID, 书籍ID, 是否更新)
+        self._queued = set()
+        self._active = set()
+        self._done = {}  # 任务ID -> 任务结束（下载结束或排队中被停止）时完成的 Future
+        self._seq = itertools.count()
+
+    async def enqueue(self, task_id: str, book_id: str, update: bool, priority: int) -> asyncio.Future:
+        """在引擎事件循环上调用，加入排队并尝试启动，返回任务结束时完成的 Future"""
+        done = self._done.get(task_id)
+        if done is None:
+            done = self._done[task_id] = asyncio.get_running_loop().create_future()
+        if task_id in self._active or task_id in self._queued:
+            return done
+        heapq.heappush(self._queue, (priority, next(self._seq), task_id, book_id, update))
+        self._queued.add(task_id)
+        self._dispatch()
+        return done
+
+    def _finish(self, task_id: str):
+        done = self._done.pop(task_id, None)
+        if done and not done.done():
+            done.set_result(None)
+
+    def _dispatch(self):
+        while self._queue and len(self._active) < self.max_active_jobs:
+            _, _, task_id, book_id, update = heapq.heappop(self._queue)
+            self._queued.discard(task_id)
+            task = task_store.get(task_id)
+            if not task or task['status'] != 'queued':
+                # 排队期间已被停止
+                self._finish(task_id)
+                continue
+            self._active.add(task_id)
+            task_store.update(task_id, status='running', queue_position=0, message='开始下载...', started_at=time.time())
+            asyncio.get_running_loop().create_task(self._run(task_id, book_id, update))
+        self._publish_positions()
+
+    async def _run(self, task_id: str, book_id: str, update: bool):
+        try:
+            await async_download_novel(book_id, task_id, update=update)
+        finally:
+            self._active.discard(task_id)
+            self._finish(task_id)
+            self._dispatch()
+
+    async def remove(self, task_id: str):
+        """排队中的任务被停止后移出队列，并重新编号其余任务"""
+        if task_id in self._queued:
+            self._queue = [entry for entry in self._queue if entry[2] != task_id]
+            heapq.heapify(self._queue)
+            self._queued.discard(task_id)
+            self._finish(task_id)
+            self._publish_positions()
+
+    def _publish_positions(self):
+        # 其他工作进程停止的任务不会通知本进程，编号前按任务状态剔除
+        position = 0
+        for entry in sorted(self._queue):
+            task_id = entry[2]
+            task = task_store.get(task_id)
+            if not task or task['status'] != 'queued':
+                self._queue.remove(entry)
+                self._queued.discard(task_id)
+                self._finish(task_id)
+                continue
+            position += 1
+            task_store.update(task_id, queue_position=position, message=f'排队中，前面还有 {position - 1} 个任务')
+        heapq.heapify(self._queue)
+
+    def stats(self) -> dict:
+        return {
+            'active_jobs': len(self._active),
+            'queued_jobs': len(self._queue),
+            'in_flight_requests': self.budget.in_flight,
+            'max_inflight_requests': self.budget.limit
+        }
+
+download_scheduler = DownloadScheduler(
+    CONFIG["scheduler"]["max_active_jobs"],
+    CONFIG["scheduler"]["max_inflight_requests"]
+)
+
+def scheduler_gauges() -> list:
+    """调度器和上游端点的当前状态，写出指标快照时读取"""
+    stats = download_scheduler.stats()
+    gauges = [
+        ('fanqie_active_jobs', (), stats['active_jobs']),
+        ('fanqie_queued_jobs', (), stats['queued_jobs']),
+        ('fanqie_inflight_requests', (), stats['in_flight_requests'])
+    ]
+    for guard in list(endpoint_guards.values()):
+        gauges.append(('fanqie_upstream_rate', (('endpoint', guard.label),), round(guard.rate, 2)))
+        gauges.append(('fanqie_upstream_circuit_open', (('endpoint', guard.label),), int(guard.state == 'open')))
+    return gauges
+
+metrics.collectors.append(scheduler_gauges)
+
+class CpuPool:
+    """章节解密、解压和清理的 CPU 工作池，fork 后的子进程会重新创建自己的池"""
+
+    def __init__(self, kind: str, workers: int):
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+        self._pid = None
+        self._lock = Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                if self.kind == 'process':
+                    # spawn 启动的工作进程不会继承引擎线程和连接池
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='cpu-pool')
+                self._pid = os.getpid()
+            return self._executor
+
+    async def run(self, func, *args):
+        """在工作池中执行 func(*args) 并等待结果"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor(), func, *args)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+
+cpu_pool = CpuPool(CONFIG["cpu_pool"]["kind"], CONFIG["cpu_pool"]["workers"])
+
+class ChapterCache:
+    """本地章节缓存，按章节ID存储压缩后的正文，超出容量时按最近使用时间淘汰。
+    缓存目录由所有工作进程共用，总大小记在任务数据库的共享计数中，淘汰前重新扫描目录"""
+
+    SIZE_KEY = 'chapter_cache_bytes'
+
+    def __init__(self, cache_dir: str, max_bytes: int, ttl: float = 0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._index = None  # 缓存文件路径 -> [大小, 最近使用时间]
+        self._total_bytes = 0
+        self._lock = Lock()
+
+    def _path(self, chapter_id: str) -> str:
+        chapter_id = str(chapter_id)
+        return os.path.join(self.cache_dir, chapter_id[-2:], f"{chapter_id}.json.gz")
+
+    def _scan(self):
+        """从缓存目录重建索引，并以目录的实际大小校正共享计数"""
+        self._index = {}
+        self._total_bytes = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                self._index[path] = [stat.st_size, stat.st_mtime]
+                self._total_bytes += stat.st_size
+        task_store.set_counter(self.SIZE_KEY, self._total_bytes)
+
+    def _ensure_index(self):
+        if self._index is None:
+            self._scan()
+
+    def _remove(self, path: str) -> int:
+        """删除缓存文件，返回释放的字节数"""
+        entry = self._index.pop(path, None)
+        if entry:
+            self._total_bytes -= entry[0]
+        try:
+            size = os.stat(path).st_size
+            os.remove(path)
+        except OSError:
+            return 0
+        return size
+
+    def get(self, chapter_id: str) -> Optional[tuple]:
+        """读取缓存的 (标题, 内容)，未命中或已过期返回 None"""
+        path = self._path(chapter_id)
+        with self._lock:
+            self._ensure_index()
+            try:
+                with open(path, 'rb') as f:
+                    data = json.loads(gzip.decompress(f.read()))
+            except (OSError, ValueError):
+                metrics.inc('fanqie_chapter_cache_lookups_total', result='miss')
+                return None
+            if self.ttl and time.time() - data['cached_at'] > self.ttl:
+                task_store.add_counter(self.SIZE_KEY, -self._remove(path))
+                metrics.inc('fanqie_chapter_cache_lookups_total', result='miss')
+                return None
+            # 更新最近使用时间，其他进程淘汰前扫描目录时据此排序
+            now = time.time()
+            if path in self._index:
+                self._index[path][1] = now
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+            metrics.inc('fanqie_chapter_cache_lookups_total', result='hit')
+            metrics.inc('fanqie_chapter_cache_saved_bytes_total', len(data['content'].encode('utf-8')))
+            return data['title'], data['content']
+
+    def get_many(self, chapter_ids: List[str]) -> Dict[str, tuple]:
+        results = {}
+        for chapter_id in chapter_ids:
+            cached = self.get(chapter_id)
+            if cached:
+                results[str(chapter_id)] = cached
+        return results
+
+    def _write(self, chapter_id: str, chapter_title: Optional[str], content: str) -> int:
+        """写入一个缓存文件，返回缓存总大小的变化量；调用方持有锁"""
+        path = self._path(chapter_id)
+        payload = gzip.compress(json.dumps({
+            'title': chapter_title,
+            'content': content,
+            'cached_at': time.time()
+        }, ensure_ascii=False).encode('utf-8'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # 以磁盘上的旧文件为准，它可能由其他进程写入
+            old_size = os.stat(path).st_size
+        except OSError:
+            old_size = 0
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        old = self._index.get(path)
+        if old:
+            self._total_bytes -= old[0]
+        self._index[path] = [len(payload), time.time()]
+        self._total_bytes += len(payload)
+        return len(payload) - old_size
+
+    def put(self, chapter_id: str, chapter_title: Optional[str], content: str):
+        """写入章节缓存，超出容量时淘汰最久未使用的章节"""
+        self.put_many({str(chapter_id): (chapter_title, content)})
+
+    def put_many(self, results: Dict[str, tuple]):
+        with self._lock:
+            self._ensure_index()
+            delta = 0
+            for chapter_id, (chapter_title, content) in results.items():
+                if content:
+                    delta += self._write(chapter_id, chapter_title, content)
+            # 每组写入只更新一次共享计数
+            if delta and task_store.add_counter(self.SIZE_KEY, delta) > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # 本进程的索引不含其他进程写入的文件，先重新扫描目录；一次淘汰到容量的 90%，避免每次写入都触发
+        self._scan()
+        target = self.max_bytes * 0.9
+        for path, _ in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self._total_bytes <= target:
+                break
+            self._remove(path)
+        task_store.set_counter(self.SIZE_KEY, self._total_bytes)
+
+    def stats(self) -> dict:
+        """所有工作进程汇总的命中情况和共享的缓存大小"""
+        with self._lock:
+            # 按目录重新统计，结果与由哪个工作进程响应无关
+            self._scan()
+            entries, size_bytes = len(self._index), self._total_bytes
+        lookups = metrics.totals('fanqie_chapter_cache_lookups_total')
+        hits = lookups.get((('result', 'hit'),), 0)
+        misses = lookups.get((('result', 'miss'),), 0)
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            'bytes_saved': sum(metrics.totals('fanqie_chapter_cache_saved_bytes_total').values()),
+            'entries': entries,
+            'size_bytes': size_bytes,
+            'max_bytes': self.max_bytes
+        }
+
+chapter_cache = ChapterCache(
+    CONFIG["chapter_cache"]["dir"],
+    CONFIG["chapter_cache"]["max_bytes"],
+    CONFIG["chapter_cache"]["ttl"]
+)
+
+# 内置的 User-Agent 列表，保证离线或 fake_useragent 不可用时也能生成请求头
+BUNDLED_USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36 Edg/123.0.0.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36 Edg/123.0.0.0"
+]
+
+class HeaderProvider:
+    """请求头生成器：首次使用时加载一次 User-Agent 池，之后都从内存中轮换"""
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self._pool = None
+        self._lock = Lock()
+
+    def _load_pool(self) -> List[str]:
+        pool = list(BUNDLED_USER_AGENTS)
+        if self.settings["use_fake_useragent"] and UserAgent is not None:
+            try:
+                ua = UserAgent(browsers=self.settings["browsers"])
+                pool.extend({ua.random for _ in range(self.settings["pool_size"])})
+            except Exception as e:
+                logger.error(f"加载 User-Agent 数据失败，使用内置列表: {str(e)}")
+        return pool
+
+    def user_agent(self) -> str:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = self._load_pool()
+        return random.choice(self._pool)
+
+    def session_headers(self) -> Dict[str, str]:
+        """一个下载任务使用的请求头"""
+        return {
+            "User-Agent": self.user_agent(),
+            "Accept": "application/json, text/javascript, */*; q=0.01",
+            "Accept-Language": "zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7",
+            "Referer": "https://fanqienovel.com/",
+            "X-Requested-With": "XMLHttpRequest",
+        }
+
+    def for_request(self, headers: Dict[str, str]) -> Dict[str, str]:
+        """按请求轮换时换一个 User-Agent，否则原样返回任务的请求头"""
+        if self.settings["rotation"] != 'request':
+            return headers
+        return {**headers, "User-Agent": self.user_agent()}
+
+header_provider = HeaderProvider(CONFIG["headers"])
 
 async def async_get_headers() -> Dict[str, str]:
     """异步生成随机请求头"""
-    browsers = ['chrome', 'edge']
-    browser = random.choice(browsers)
+    return header_provider.session_headers()
+
+# 章节清理用到的正则，模块加载时编译一次
+HEADER_RE = re.compile(r'<header>.*?</header>', re.DOTALL)
+FOOTER_RE = re.compile(r'<footer>.*?</footer>', re.DOTALL)
+ARTICLE_RE = re.compile(r'</?article>')
+PARAGRAPH_RE = re.compile(r'<p[^>]*>')
+PARAGRAPH_END_RE = re.compile(r'</p>')
+TAG_RE = re.compile(r'<[^>]+>')
+# 必须在去掉标签之后单独执行：转义的尖括号可能夹在标签中间，如 "\u003<b>c"
+ESCAPED_BRACKET_RE = re.compile(r'\\u003c|\\u003e')
+CHAPTER_NO_RE = re.compile(r'^第[0-9]+章\s*')
+
+def clean_chapter_content(content: str, chapter_title: Optional[str]) -> str:
+    """清理章节HTML内容并格式化段落缩进"""
+    content = HEADER_RE.sub('', content)
+    content = FOOTER_RE.sub('', content)
+    content = ARTICLE_RE.sub('', content)
+    content = PARAGRAPH_RE.sub('\n', content)
+    content = PARAGRAPH_END_RE.sub('', content)
+    content = TAG_RE.sub('', content)
+    content = ESCAPED_BRACKET_RE.sub('', content)
     
-    if browser == 'chrome':
-        user_agent = UserAgent().chrome
-    else:
-        user_agent = UserAgent().edge
+    if chapter_title and content.startswith(chapter_title):
+        content = content[len(chapter_title):]
     
-    return {
-        "User-Agent": user_agent,
-        "Accept": "application/json, text/javascript, */*; q=0.01",
-        "Accept-Language": "zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7",
-        "Referer": "https://fanqienovel.com/",
-        "X-Requested-With": "XMLHttpRequest",
-    }
+    # 逐行去掉首尾空白并丢弃空行，一次完成原先的合并空行、strip 和缩进
+    return '\n'.join(['    ' + line for line in map(str.strip, content.split('\n')) if line])
 
-async def async_down_text(session: aiohttp.ClientSession, chapter_id: str, headers: Dict[str, str], book_id: Optional[str] = None):
-    """异步下载章节内容"""
-    try:
-        # 使用官方API
-        var = FqVariable(
-            CONFIG["official_api"]["install_id"],
-            CONFIG["official_api"]["server_device_id"],
-            CONFIG["official_api"]["aid"],
-            CONFIG["official_api"]["update_version_code"]
-        )
-        client = FqReq(var)
+def decode_official_contents(data: Dict[str, dict], key: str) -> Dict[str, tuple]:
+    """解密、解压并清理官方接口返回的一组章节，在 CPU 工作池中执行"""
+    crypto = FqCrypto(key)
+    results = {}
+    decrypt_time = clean_time = 0.0
+    for item_id, v in data.items():
+        started = time.perf_counter()
+        content = gzip.decompress(crypto.decrypt(base64.b64decode(v['content']))).decode('utf-8')
+        decrypted = time.perf_counter()
+        chapter_title = v.get('title')
         
-        # 获取解密密钥
-        key = client.get_register_key()
-        crypto = FqCrypto(key)
+        # 处理标题和内容
+        if chapter_title:
+            chapter_title = CHAPTER_NO_RE.sub('', chapter_title, count=1)
         
-        # 获取章节内容
-        batch_res_arr = await asyncio.to_thread(client.batch_get, chapter_id, False)
-        res = await asyncio.to_thread(client.get_decrypt_contents, batch_res_arr)
-        
-        for k, v in res['data'].items():
-            content = v['originContent']
-            chapter_title = v['title']
-            
-            # 处理标题和内容
-            if chapter_title and re.match(r'^第[0-9]+章', chapter_title):
-                chapter_title = re.sub(r'^第[0-9]+章\s*', '', chapter_title)
-            
-            content = re.sub(r'<header>.*?</header>', '', content, flags=re.DOTALL)
-            content = re.sub(r'<footer>.*?</footer>', '', content, flags=re.DOTALL)
-            content = re.sub(r'</?article>', '', content)
-            content = re.sub(r'<p[^>]*>', '\n    ', content)
-            content = re.sub(r'</p>', '', content)
-            content = re.sub(r'<[^>]+>', '', content)
-            content = re.sub(r'\\u003c|\\u003e', '', content)
-            
-            if chapter_title and content.startswith(chapter_title):
-                content = content[len(chapter_title):].lstrip()
+        results[str(item_id)] = (chapter_title, clean_chapter_content(content, chapter_title))
+        decrypt_time += decrypted - started
+        clean_time += time.perf_counter() - decrypted
+    # 每组记录一次；进程池中执行时由工作进程自己写出指标
+    metrics.observe('fanqie_stage_seconds', decrypt_time, stage='decrypt')
+    metrics.observe('fanqie_stage_seconds', clean_time, stage='clean')
+    return results
+
+def clean_chapters(raw: Dict[str, tuple]) -> Dict[str, tuple]:
+    """批量清理备用接口返回的章节HTML，在 CPU 工作池中执行"""
+    with metrics.timer('fanqie_stage_seconds', stage='clean'):
+        return {
+            chapter_id: (chapter_title, clean_chapter_content(content, chapter_title))
+            for chapter_id, (chapter_title, content) in raw.items()
+        }
+
+async def in_budget(job_id: Optional[str], request_func):
+    """每个上游请求发出前先从进程级配额中领取名额，请求结束即归还"""
+    async with download_scheduler.budget.slot(job_id):
+        return await request_func()
+
+async def async_down_official(session: aiohttp.ClientSession, chapter_ids: List[str], job_id: Optional[str] = None) -> Dict[str, tuple]:
+    """通过官方API批量下载章节内容，返回 章节ID -> (标题, 内容)"""
+    client = FqReq(get_fq_variable(), session)
+    
+    # 一次 batch_get 取回整组章节，解密和清理整组交给 CPU 工作池
+    crypto = await register_key_manager.get_crypto(client)
+    with metrics.timer('fanqie_stage_seconds', stage='batch_get'):
+        batch_res_arr = await guarded_request('official', lambda: in_budget(job_id, lambda: client.batch_get(chapter_ids, False)))
+    try:
+        return await cpu_pool.run(decode_official_contents, batch_res_arr['data'], crypto.key.hex())
+    except ValueError:
+        # 填充或密钥错误，说明密钥已失效，刷新密钥后重新获取一次
+        register_key_manager.invalidate(crypto)
+        crypto = await register_key_manager.get_crypto(client)
+        with metrics.timer('fanqie_stage_seconds', stage='batch_get'):
+            batch_res_arr = await guarded_request('official', lambda: in_budget(job_id, lambda: client.batch_get(chapter_ids, False)))
+        return await cpu_pool.run(decode_official_contents, batch_res_arr['data'], crypto.key.hex())
+
+def rank_fallback_endpoints() -> List[str]:
+    """按健康状况排序备用接口：熔断的排最后，其余按近期成功率降序、p50 延迟升序"""
+    def score(api_endpoint):
+        guard = get_endpoint_guard(api_endpoint)
+        p50 = guard.latency_percentile(0.5)
+        return (guard.state == 'open', -guard.success_rate(), p50 if p50 is not None else 0.0)
+    return sorted(CONFIG["api_endpoints"], key=score)
+
+def hedge_delay(api_endpoint: str) -> float:
+    """对冲前等待的时间：取该接口近期延迟的分位数，样本不足时使用默认值"""
+    settings = CONFIG["fallback"]
+    delay = get_endpoint_guard(api_endpoint).latency_percentile(settings["hedge_percentile"], settings["min_samples"])
+    if delay is None:
+        return settings["hedge_default_delay"]
+    return min(CONFIG["request_timeout"], max(settings["hedge_min_delay"], delay))
+
+async def async_down_endpoint(session: aiohttp.ClientSession, api_endpoint: str, chapter_id: str, headers: Dict[str, str],
+                              job_id: Optional[str] = None):
+    """从单个备用接口获取章节原始内容 (标题, HTML)，失败或内容为空时返回 None"""
+    url = api_endpoint.format(chapter_id=chapter_id)
+    
+    async def fetch():
+        # 对冲请求同样占用配额，官方接口失败时整组章节的备用请求也受 max_inflight_requests 限制
+        async with download_scheduler.budget.slot(job_id):
+            async with session.get(url, headers=header_provider.for_request(headers), timeout=CONFIG["request_timeout"], ssl=False) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+    
+    guard = get_endpoint_guard(api_endpoint)
+    started = time.monotonic()
+    try:
+        data = await guarded_request(api_endpoint, fetch)
+        content = data.get("data", {}).get("content", "")
+        chapter_title = data.get("data", {}).get("title", "")
+    except CircuitOpenError:
+        return None
+    except asyncio.CancelledError:
+        # 被对冲请求抢先时记为一次失败，已等待的时间作为延迟下限，否则卡住的接口永远没有样本
+        guard.observe(False, time.monotonic() - started)
+        raise
+    except Exception as e:
+        guard.observe(False, time.monotonic() - started)
+        logger.error(f"备用API请求失败: {str(e)}")
+        return None
+    
+    guard.observe(bool(content), time.monotonic() - started)
+    if not content:
+        return None
+    return chapter_title, content
+
+async def async_down_fallback(session: aiohttp.ClientSession, chapter_id: str, headers: Dict[str, str],
+                              job_id: Optional[str] = None):
+    """通过备用API下载单个章节的原始内容，按健康排序依次尝试，慢响应时对冲请求下一个接口"""
+    endpoints = deque(rank_fallback_endpoints())
+    pending = {}
+    started = time.perf_counter()
+    try:
+        while endpoints or pending:
+            if endpoints and not pending:
+                api_endpoint = endpoints.popleft()
+                pending[asyncio.ensure_future(async_down_endpoint(session, api_endpoint, chapter_id, headers, job_id))] = api_endpoint
             
-            content = re.sub(r'\n{3,}', '\n\n', content).strip()
-            lines = [line.strip() for line in content.split('\n') if line.strip()]
-            formatted_content = '\n'.join(['    ' + line for line in lines])
+            timeout = None
+            if endpoints and CONFIG["fallback"]["hedge"]:
+                timeout = min(hedge_delay(api_endpoint) for api_endpoint in pending.values())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
             
-            return chapter_title, formatted_content
+            if not done:
+                # 当前接口超过延迟分位数仍未返回，同时请求下一个接口
+                api_endpoint = endpoints.popleft()
+                pending[asyncio.ensure_future(async_down_endpoint(session, api_endpoint, chapter_id, headers, job_id))] = api_endpoint
+                continue
+            for task in done:
+                del pending[task]
+                if task.result():
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        metrics.observe('fanqie_stage_seconds', time.perf_counter() - started, stage='fallback')
             
+    return None, None
+
+async def async_down_batch(session: aiohttp.ClientSession, chapter_ids: List[str], headers: Dict[str, str],
+                           job_id: Optional[str] = None) -> Dict[str, tuple]:
+    """异步批量下载章节内容，优先读取本地缓存，官方API未返回的章节逐个使用备用API"""
+    results = {}
+    if CONFIG["chapter_cache"]["enabled"]:
+        results = await asyncio.to_thread(chapter_cache.get_many, chapter_ids)
+    
+    remaining = [chapter_id for chapter_id in chapter_ids if str(chapter_id) not in results]
+    if results:
+        metrics.inc('fanqie_chapters_total', len(results), source='cache')
+    if not remaining:
+        return results
+    
+    fetched = {}
+    try:
+        fetched = await async_down_official(session, remaining, job_id)
     except Exception as e:
-        logger.error(f"官方API请求失败: {str(e)}")
-        
-        # 尝试备用API
-        for api_endpoint in CONFIG["api_endpoints"]:
-            try:
-                url = api_endpoint.format(chapter_id=chapter_id)
-                async with session.get(url, headers=headers, timeout=CONFIG["request_timeout"], ssl=False) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        content = data.get("data", {}).get("content", "")
-                        chapter_title = data.get("data", {}).get("title", "")
-                        
-                        if content:
-                            # 处理内容
-                            content = re.sub(r'<header>.*?</header>', '', content, flags=re.DOTALL)
-                            content = re.sub(r'<footer>.*?</footer>', '', content, flags=re.DOTALL)
-                            content = re.sub(r'</?article>', '', content)
-                            content = re.sub(r'<p[^>]*>', '\n    ', content)
-                            content = re.sub(r'</p>', '', content)
-                            content = re.sub(r'<[^>]+>', '', content)
-                            content = re.sub(r'\\u003c|\\u003e', '', content)
-                            
-                            if chapter_title and content.startswith(chapter_title):
-                                content = content[len(chapter_title):].lstrip()
-                            
-                            content = re.sub(r'\n{3,}', '\n\n', content).strip()
-                            lines = [line.strip() for line in content.split('\n') if line.strip()]
-                            formatted_content = '\n'.join(['    ' + line for line in lines])
-                            
-                            return chapter_title, formatted_content
-                            
-            except Exception as e:
-                logger.error(f"备用API请求失败: {str(e)}")
-                continue
-                
-        return None, None
+        logger.error(f"官方API批量请求失败: {str(e)}")
+    
+    if fetched:
+        metrics.inc('fanqie_chapters_total', len(fetched), source='official')
+    missing = [chapter_id for chapter_id in remaining if str(chapter_id) not in fetched]
+    if missing:
+        fallback_results = await asyncio.gather(
+            *(async_down_fallback(session, chapter_id, headers, job_id) for chapter_id in missing)
+        )
+        raw = {}
+        for chapter_id, result in zip(missing, fallback_results):
+            if result[1]:
+                raw[str(chapter_id)] = result
+            else:
+                fetched[str(chapter_id)] = result
+        metrics.inc('fanqie_chapters_total', len(raw), source='fallback')
+        metrics.inc('fanqie_chapters_total', len(missing) - len(raw), source='failed')
+        if raw:
+            fetched.update(await cpu_pool.run(clean_chapters, raw))
+    
+    if CONFIG["chapter_cache"]["enabled"]:
+        try:
+            await asyncio.to_thread(chapter_cache.put_many, fetched)
+        except Exception as e:
+            logger.error(f"写入章节缓存失败: {str(e)}")
+    results.update(fetched)
+    return results
+
+def split_batches(chapters: List[Dict]) -> List[List[Dict]]:
+    """按官方接口批量大小将章节分组"""
+    batch_size = max(1, min(CONFIG["batch_size"], OFFICIAL_BATCH_LIMIT))
+    return [chapters[i:i + batch_size] for i in range(0, len(chapters), batch_size)]
 
 async def async_get_chapters(session: aiohttp.ClientSession, book_id: str, headers: Dict[str, str]) -> List[Dict]:
     """异步获取章节列表"""
-    url = f"https://fanqienovel.com/api/reader/directory/detail?bookId={book_id}"
+    url = f"{CONFIG['web_base_url']}/api/reader/directory/detail?bookId={book_id}"
     try:
-        async with session.get(url, headers=headers, timeout=CONFIG["request_timeout"], ssl=False) as response:
+        async with session.get(url, headers=header_provider.for_request(headers), timeout=CONFIG["request_timeout"], ssl=False) as response:
             if response.status != 200:
                 return None
                 
@@ -373,149 +1796,618 @@ async def async_get_chapters(session: aiohttp.ClientSession, book_id: str, heade
         logger.error(f"获取章节列表失败: {str(e)}")
         return None
 
+# 书籍页面的定向提取规则，结构不匹配时回退到 BeautifulSoup
+BOOK_NAME_RE = re.compile(r'<h1(?:\s[^>]*)?>(.*?)</h1>', re.DOTALL)
+AUTHOR_RE = re.compile(
+    r'<div\s[^>]*class="(?:[^"]*\s)?author-name(?:\s[^"]*)?"[^>]*>(?:(?!</div>).)*?'
+    r'<span\s[^>]*class="(?:[^"]*\s)?author-name-text(?:\s[^"]*)?"[^>]*>(.*?)</span>',
+    re.DOTALL
+)
+DESCRIPTION_RE = re.compile(
+    r'<div\s[^>]*class="(?:[^"]*\s)?page-abstract-content(?:\s[^"]*)?"[^>]*>(?:(?!</div>).)*?'
+    r'<p(?:\s[^>]*)?>(.*?)</p>',
+    re.DOTALL
+)
+INNER_TAG_RE = re.compile(r'<[^>]+>')
+
+def parse_book_info_soup(html: str) -> tuple:
+    """用 BeautifulSoup 完整解析书籍页面"""
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    
+    name = "未知书名"
+    name_element = soup.find('h1')
+    if name_element:
+        name = name_element.text
+    
+    author_name = "未知作者"
+    author_name_element = soup.find('div', class_='author-name')
+    if author_name_element:
+        author_name_span = author_name_element.find('span', class_='author-name-text')
+        if author_name_span:
+            author_name = author_name_span.text
+    
+    description = "无简介"
+    description_element = soup.find('div', class_='page-abstract-content')
+    if description_element:
+        description_p = description_element.find('p')
+        if description_p:
+            description = description_p.text
+    
+    return name, author_name, description
+
+def parse_book_info(html: str) -> tuple:
+    """只定位书名、作者和简介三处元素，任一处没匹配到时回退到完整解析"""
+    matches = [regex.search(html) for regex in (BOOK_NAME_RE, AUTHOR_RE, DESCRIPTION_RE)]
+    if not all(matches):
+        return parse_book_info_soup(html)
+    return tuple(unescape(INNER_TAG_RE.sub('', match.group(1))) for match in matches)
+
 async def async_get_book_info(session: aiohttp.ClientSession, book_id: str, headers: Dict[str, str]):
-    """异步获取书籍信息"""
-    url = f'https://fanqienovel.com/page/{book_id}'
+    """异步获取书籍信息，优先使用未过期的缓存"""
+    cached = task_store.get_book_info(book_id, CONFIG["book_info_ttl"])
+    if cached:
+        return cached
+    
+    url = f"{CONFIG['web_base_url']}/page/{book_id}"
     try:
-        async with session.get(url, headers=headers, timeout=CONFIG["request_timeout"], ssl=False) as response:
-            if response.status != 200:
-                return None, None, None
-                
-            html = await response.text()
-            soup = bs4.BeautifulSoup(html, 'html.parser')
-            
-            name = "未知书名"
-            name_element = soup.find('h1')
-            if name_element:
-                name = name_element.text
-            
-            author_name = "未知作者"
-            author_name_element = soup.find('div', class_='author-name')
-            if author_name_element:
-                author_name_span = author_name_element.find('span', class_='author-name-text')
-                if author_name_span:
-                    author_name = author_name_span.text
-            
-            description = "无简介"
-            description_element = soup.find('div', class_='page-abstract-content')
-            if description_element:
-                description_p = description_element.find('p')
-                if description_p:
-                    description = description_p.text
-            
-            return name, author_name, description
+        with metrics.timer('fanqie_stage_seconds', stage='book_info'):
+            async with session.get(url, headers=header_provider.for_request(headers), timeout=CONFIG["request_timeout"], ssl=False) as response:
+                if response.status != 200:
+                    return None, None, None
+                html = await response.text()
+        name, author_name, description = parse_book_info(html)
+        if name != "未知书名":
+            task_store.put_book_info(book_id, name, author_name, description)
+        return name, author_name, description
             
     except Exception as e:
         logger.error(f"获取书籍信息失败: {str(e)}")
         return None, None, None
 
+def get_task_view(task_id: str) -> Optional[dict]:
+    """获取任务状态，合并到同一下载的任务共享主任务的进度和文件"""
+    task = task_store.get(task_id)
+    if task is None:
+        return None
+    job_id = task.get('attached_to') or task_id
+    job = task_store.get(job_id) if job_id != task_id else task
+    if job is None:
+        # 主任务已过期被清理，合并的任务保存的状态不再有效
+        view = dict(task, status='stopped', message='下载记录已过期，请重新下载', file_path=None)
+        for key in ('subscribed', 'stop_requested', 'owner', 'updated_at'):
+            view.pop(key, None)
+        return view
+    
+    # 执行下载的进程已经退出（重启或崩溃），标记为已停止以便继续下载
+    if job['status'] in ('queued', 'running') and job.get('owner') and not owner_alive(job['owner']):
+        task_store.update(job['task_id'], status='stopped', message='下载已中断，可继续下载')
+        job = task_store.get(job['task_id'])
+    
+    view = dict(job)
+    if job_id != task_id:
+        view.update({
+            'task_id': task_id,
+            'mode': task.get('mode'),
+            'created_at': task.get('created_at'),
+            'attached_to': job_id
+        })
+    # 已退订的任务对用户显示为停止，下载本身继续服务其他任务
+    if view['status'] in ('queued', 'running') and not task['subscribed']:
+        view.update({'status': 'stopped', 'message': '下载已停止'})
+    for key in ('subscribed', 'stop_requested', 'owner', 'updated_at'):
+        view.pop(key, None)
+    return view
+
 def stop_download(task_id: str):
-    """停止下载任务"""
-    if task_id in download_controls:
-        download_controls[task_id]['stop'] = True
-        logger.info(f"任务 {task_id} 已停止")
-        return True
-    return False
+    """停止下载任务，仍有其他任务共享时只退订当前任务"""
+    dequeued = None
+    with task_store.transaction() as conn:
+        task = task_store.get(task_id, conn)
+        if task is None:
+            return False
+        job_id = task.get('attached_to') or task_id
+        task_store.update(task_id, conn, subscribed=0)
+        if not task_store.count_subscribers(job_id, conn):
+            task_store.update(job_id, conn, stop_requested=1)
+            # 尚在排队的任务直接停止，调度器出队时会跳过
+            if task_store.get(job_id, conn)['status'] == 'queued':
+                task_store.update(job_id, conn, status='stopped', message='下载已停止', queue_position=0)
+                dequeued = job_id
+    if dequeued:
+        download_engine.submit(download_scheduler.remove(dequeued))
+    logger.info(f"任务 {task_id} 已停止")
+    return True
+
+def is_stop_requested(task_id: str) -> bool:
+    """下载过程中检查是否收到停止请求"""
+    return task_store.is_stop_requested(task_id)
+
+def get_manifest_file(book_id: str) -> str:
+    """获取书籍的章节清单文件路径"""
+    return os.path.join('downloads', book_id, 'manifest.jsonl')
 
-def save_progress(book_id: str, progress: dict):
-    """保存下载进度"""
-    progress_file = os.path.join('downloads', f"{book_id}_progress.json")
+def start_manifest(manifest_file: str, book: dict):
+    """新建章节清单，首行记录书籍信息"""
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(dict(book, type='book'), ensure_ascii=False) + '\n')
+
+def load_manifest(book_id: str) -> Optional[dict]:
+    """加载章节清单，同一章节以最后一条记录为准"""
+    manifest_file = get_manifest_file(book_id)
+    if not os.path.exists(manifest_file):
+        return None
+    book = None
+    records = {}
     try:
-        with open(progress_file, 'w', encoding='utf-8') as f:
-            json.dump(progress, f, ensure_ascii=False, indent=2)
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时可能留下不完整的末行
+                    continue
+                if record.get('type') == 'book':
+                    book = record
+                else:
+                    records[record['id']] = record
     except Exception as e:
-        logger.error(f"保存进度失败: {str(e)}")
+        logger.error(f"加载章节清单失败: {str(e)}")
+        return None
+    if not book:
+        return None
+    return {'book': book, 'chapters': records}
 
-def load_progress(book_id: str) -> dict:
-    """加载下载进度"""
-    progress_file = os.path.join('downloads', f"{book_id}_progress.json")
-    if os.path.exists(progress_file):
-        try:
-            with open(progress_file, 'r', encoding='utf-8') as f:
-                progress = json.load(f)
-                # 检查进度文件是否在24小时内
-                if time.time() - progress.get('timestamp', 0) < 86400:  # 24小时
-                    return progress
-        except Exception as e:
-            logger.error(f"加载进度失败: {str(e)}")
+def trim_manifest_tail(manifest_file: str):
+    """截掉崩溃时写了一半的末行，否则继续追加的第一条记录会和它拼成一行而被丢弃"""
+    with open(manifest_file, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+def verify_manifest(output_file: str, records: Dict[str, dict]) -> Dict[str, dict]:
+    """校验清单中已完成章节的偏移和哈希，返回仍然有效的记录"""
+    valid = {}
+    if not os.path.exists(output_file):
+        return valid
+    size = os.path.getsize(output_file)
+    with open(output_file, 'rb') as f:
+        for chapter_id, record in records.items():
+            if record.get('status') != 'ok' or record['offset'] + record['length'] > size:
+                continue
+            f.seek(record['offset'])
+            if hashlib.sha1(f.read(record['length'])).hexdigest() == record['sha1']:
+                valid[chapter_id] = record
+    return valid
+
+class ChapterWriter:
+    """按章节顺序写入输出文件，文件在任务期间保持打开，并同步追加章节清单"""
+
+    def __init__(self, output_file: str, manifest_file: str, buffer_size: int, fsync_interval: int,
+                 start_index: int = 0, source_file: Optional[str] = None):
+        self.output_file = output_file
+        self.manifest_file = manifest_file
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.source_file = source_file  # 重建时从旧文件复制已完成的章节
+        self.written = 0  # 本次新写入的成功章节数
+        self.failed = []  # 下载失败的章节标题
+        self._file = None
+        self._manifest = None
+        self._source = None
+        self._offset = 0
+        self._pending = {}  # 乱序到达、等待写入的章节
+        self._next_index = start_index
+        self._buffer = []
+        self._records = []
+        self._buffered_bytes = 0
+        self._since_fsync = 0
+
+    async def open(self):
+        self._file = await aiofiles.open(self.output_file, 'ab')
+        self._offset = await self._file.tell()
+        self._manifest = await aiofiles.open(self.manifest_file, 'a', encoding='utf-8')
+        if self.source_file:
+            self._source = await aiofiles.open(self.source_file, 'rb')
+
+    async def add(self, index: int, chapter: Dict, chapter_title: Optional[str], content: Optional[str]):
+        """接收一个已完成的章节，连续的章节按顺序进入写缓冲"""
+        self._pending[index] = (chapter, chapter_title, content, None)
+        await self._drain()
+
+    async def add_existing(self, index: int, chapter: Dict, record: dict):
+        """登记一个旧文件中已完成的章节，轮到它时原样复制"""
+        self._pending[index] = (chapter, None, None, record)
+
+    async def _drain(self, skip_gaps: bool = False):
+        while self._pending:
+            if self._next_index not in self._pending:
+                if not skip_gaps:
+                    break
+                self._next_index = min(self._pending)
+            chapter, chapter_title, content, record = self._pending.pop(self._next_index)
+            self._next_index += 1
+            if record:
+                await self._source.seek(record['offset'])
+                await self._emit(chapter, await self._source.read(record['length']), 'ok')
+            elif content:
+                if chapter_title:
+                    text = f'{chapter["title"]} {chapter_title}\n{content}\n\n'
+                else:
+                    text = f'{chapter["title"]}\n{content}\n\n'
+                self.written += 1
+                await self._emit(chapter, text.encode('utf-8'), 'ok')
+            else:
+                # 失败的章节保留占位，避免后续章节错位，续传时会重新下载
+                logger.error(f"章节 {chapter['title']} 下载失败")
+                self.failed.append(chapter['title'])
+                await self._emit(chapter, f'{chapter["title"]} [下载失败]\n\n'.encode('utf-8'), 'failed')
+
+    async def _emit(self, chapter: Dict, data: bytes, status: str):
+        self._buffer.append(data)
+        self._records.append({
+            'id': chapter['id'],
+            'index': chapter['index'],
+            'title': chapter['title'],
+            'status': status,
+            'offset': self._offset,
+            'length': len(data),
+            'sha1': hashlib.sha1(data).hexdigest()
+        })
+        self._offset += len(data)
+        self._buffered_bytes += len(data)
+        self._since_fsync += 1
+        if self._buffered_bytes >= self.buffer_size:
+            await self.flush(fsync=self._since_fsync >= self.fsync_interval)
+
+    async def flush(self, fsync: bool = False):
+        """写出缓冲区，先写正文再写清单，检查点时同步到磁盘"""
+        if self._buffer:
+            with metrics.timer('fanqie_stage_seconds', stage='write'):
+                await self._file.write(b''.join(self._buffer))
+                await self._file.flush()
+                await self._manifest.write(''.join(
+                    json.dumps(record, ensure_ascii=False) + '\n' for record in self._records
+                ))
+            metrics.inc('fanqie_written_bytes_total', self._buffered_bytes)
+            self._buffer = []
+            self._records = []
+            self._buffered_bytes = 0
+            # 清单随正文写出后，正在跟读该文件的流式连接即可读取新章节
+            await self._manifest.flush()
+            change_notifier.notify()
+        if fsync:
+            for f in (self._file, self._manifest):
+                await f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+            self._since_fsync = 0
+
+    async def close(self):
+        """写出所有已完成的章节（跳过未下载的空位）并关闭文件"""
+        if self._file:
+            await self._drain(skip_gaps=True)
+            await self.flush(fsync=True)
+            for f in (self._file, self._manifest, self._source):
+                if f:
+                    await f.close()
+            self._file = self._manifest = self._source = None
+
+# 预压缩副本的扩展名，副本的修改时间与原文件保持一致，不一致即视为过期
+SIDECAR_SUFFIXES = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+
+def available_encodings() -> List[str]:
+    """返回配置中且依赖模块可用的压缩编码"""
+    modules = {"br": brotli, "zstd": zstandard, "gzip": gzip}
+    return [e for e in CONFIG["compression"]["encodings"] if modules.get(e) is not None]
+
+def sidecar_path(file_path: str, encoding: str) -> Optional[str]:
+    """返回与原文件对应且未过期的预压缩副本路径"""
+    path = file_path + SIDECAR_SUFFIXES[encoding]
+    try:
+        if os.stat(path).st_mtime_ns == os.stat(file_path).st_mtime_ns:
+            return path
+    except OSError:
+        pass
     return None
 
+def build_sidecars(file_path: str, encodings: List[str], settings: dict) -> Dict[str, int]:
+    """为完成的文件生成预压缩副本，返回各编码的副本大小；在 CPU 工作池中执行"""
+    sizes = {}
+    for encoding in encodings:
+        path = file_path + SIDECAR_SUFFIXES[encoding]
+        if sidecar_path(file_path, encoding):
+            sizes[encoding] = os.path.getsize(path)
+            continue
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(file_path, 'rb') as src, open(tmp, 'wb') as dst:
+            if encoding == "gzip":
+                # mtime 固定为 0，同一内容生成的副本逐字节一致
+                with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=settings["gzip_level"], mtime=0) as gz:
+                    shutil.copyfileobj(src, gz, 1024 * 1024)
+            elif encoding == "zstd":
+                zstandard.ZstdCompressor(level=settings["zstd_level"]).copy_stream(src, dst)
+            else:
+                compressor = brotli.Compressor(quality=settings["brotli_quality"])
+                for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                    dst.write(compressor.process(chunk))
+                dst.write(compressor.finish())
+        st = os.stat(file_path)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, path)
+        sizes[encoding] = os.path.getsize(path)
+    return sizes
+
+# 正在生成副本的文件，避免同一进程内重复压缩
+compressing_books = set()
+
+async def compress_book(file_path: str):
+    """下载完成后生成预压缩副本，失败时仍可发送原文件"""
+    if file_path in compressing_books:
+        return
+    compressing_books.add(file_path)
+    try:
+        sizes = await cpu_pool.run(build_sidecars, file_path, available_encodings(), CONFIG["compression"])
+        logger.info(f"已生成压缩副本 {os.path.basename(file_path)}: {sizes}")
+    except Exception as e:
+        logger.error(f"生成压缩副本失败: {str(e)}")
+    finally:
+        compressing_books.discard(file_path)
+
+def remove_sidecars(file_path: str):
+    """删除文件的全部预压缩副本"""
+    for suffix in SIDECAR_SUFFIXES.values():
+        try:
+            os.remove(file_path + suffix)
+        except FileNotFoundError:
+            pass
+
+# 章节索引文件（与 TXT 同名加 .idx）：文件头记录生成时 TXT 的大小和修改时间，不一致即过期；
+# 之后是按章节顺序排列的定长记录，第 n 章的记录位置可以直接算出；最后是标题区
+CHAPTER_INDEX_MAGIC = b'FQCI'
+CHAPTER_INDEX_HEADER = struct.Struct('<4sIQQ')  # 魔数、章节数、TXT 大小、TXT 修改时间（纳秒）
+CHAPTER_INDEX_RECORD = struct.Struct('<QIII')  # 章节偏移、章节长度、标题在标题区的偏移、标题长度
+
+def build_chapter_index(output_file: str, manifest: dict) -> str:
+    """根据章节清单生成章节索引，标题取章节正文的首行"""
+    records = sorted(manifest['chapters'].values(), key=lambda record: record['index'])
+    st = os.stat(output_file)
+    packed, titles = [], bytearray()
+    with open(output_file, 'rb') as f:
+        for record in records:
+            f.seek(record['offset'])
+            title = f.readline(min(record['length'], 1024)).strip() or record['title'].encode('utf-8')
+            packed.append(CHAPTER_INDEX_RECORD.pack(record['offset'], record['length'], len(titles), len(title)))
+            titles += title
+    index_file = output_file + '.idx'
+    tmp = f"{index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(CHAPTER_INDEX_HEADER.pack(CHAPTER_INDEX_MAGIC, len(records), st.st_size, st.st_mtime_ns))
+        f.write(b''.join(packed))
+        f.write(titles)
+    # 替换而不是原地改写，其他进程已映射的旧索引仍然可读
+    os.replace(tmp, index_file)
+    return index_file
+
+class ChapterIndex:
+    """以内存映射方式打开的章节索引，按章节序号 O(1) 取得偏移、长度和标题"""
+
+    def __init__(self, index_file: str):
+        with open(index_file, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.size, self.mtime_ns = CHAPTER_INDEX_HEADER.unpack_from(self._map, 0)
+        if magic != CHAPTER_INDEX_MAGIC:
+            raise ValueError('章节索引格式不正确')
+        self._titles = CHAPTER_INDEX_HEADER.size + self.count * CHAPTER_INDEX_RECORD.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def matches(self, st: os.stat_result) -> bool:
+        return self.size == st.st_size and self.mtime_ns == st.st_mtime_ns
+
+    def record(self, position: int) -> tuple:
+        """第 position 章（从 0 开始）的 (偏移, 长度, 标题)"""
+        offset, length, title_offset, title_length = CHAPTER_INDEX_RECORD.unpack_from(
+            self._map, CHAPTER_INDEX_HEADER.size + position * CHAPTER_INDEX_RECORD.size
+        )
+        start = self._titles + title_offset
+        return offset, length, self._map[start:start + title_length].decode('utf-8', errors='replace')
+
+# 本进程已映射的章节索引，按最近使用淘汰；淘汰的映射在没有引用后由垃圾回收关闭
+chapter_indexes = OrderedDict()
+chapter_indexes_lock = Lock()
+
+def get_chapter_index(book_id: str, output_file: str) -> Optional[ChapterIndex]:
+    """取得与 TXT 当前内容一致的章节索引，缺失或过期时根据章节清单重新生成"""
+    st = os.stat(output_file)
+    with chapter_indexes_lock:
+        index = chapter_indexes.get(output_file)
+        if index and index.matches(st):
+            chapter_indexes.move_to_end(output_file)
+            return index
+    try:
+        index = ChapterIndex(output_file + '.idx')
+    except (OSError, ValueError, struct.error):
+        index = None
+    if not index or not index.matches(st):
+        manifest = load_manifest(book_id)
+        if not manifest or manifest['book']['output_file'] != output_file:
+            return None
+        index = ChapterIndex(build_chapter_index(output_file, manifest))
+    with chapter_indexes_lock:
+        chapter_indexes[output_file] = index
+        chapter_indexes.move_to_end(output_file)
+        while len(chapter_indexes) > CONFIG["chapter_index"]["cache_size"]:
+            chapter_indexes.popitem(last=False)
+    return index
+
+async def index_book(book_id: str, output_file: str):
+    """下载完成后生成章节索引，失败时在首次读取章节时再生成"""
+    try:
+        manifest = load_manifest(book_id)
+        if manifest:
+            await asyncio.to_thread(build_chapter_index, output_file, manifest)
+    except Exception as e:
+        logger.error(f"生成章节索引失败: {str(e)}")
+
 async def async_download_chapters(session: aiohttp.ClientSession, chapters: List[Dict], headers: Dict[str, str], 
                                 output_file: str, task_id: str, book_id: str):
-    """异步下载章节"""
+    """异步下载章节，根据章节清单只下载缺失或失败的章节"""
     total_chapters = len(chapters)
-    downloaded = 0
-    
-    # 加载之前的进度
-    progress = load_progress(book_id)
-    if progress:
-        downloaded = progress.get('downloaded', 0)
-        chapters = chapters[downloaded:]  # 跳过已下载的章节
-        logger.info(f"从第 {downloaded + 1} 章继续下载")
-    
-    # 将章节分成多个批次
-    for i in range(0, len(chapters), CONFIG["chunk_size"]):
-        # 检查是否需要停止
-        if task_id in download_controls and download_controls[task_id]['stop']:
-            logger.info(f"任务 {task_id} 被用户停止")
-            # 保存当前进度
-            save_progress(book_id, {
-                'downloaded': downloaded,
-                'timestamp': time.time()
-            })
-            download_tasks[task_id].update({
-                'status': 'stopped',
-                'message': '下载已停止'
-            })
-            return
-            
-        chunk = chapters[i:i + CONFIG["chunk_size"]]
-        tasks = []
-        
-        for chapter in chunk:
-            task = asyncio.create_task(async_down_text(session, chapter["id"], headers))
-            tasks.append((chapter, task))
-        
-        # 等待所有任务完成
-        for chapter, task in tasks:
+    manifest_file = get_manifest_file(book_id)
+    manifest = load_manifest(book_id)
+    
+    # 校验清单中已完成的章节
+    kept = {}
+    if manifest:
+        valid = await asyncio.to_thread(verify_manifest, output_file, manifest['chapters'])
+        kept = {position: valid[chapter["id"]] for position, chapter in enumerate(chapters) if chapter["id"] in valid}
+    
+    # 文件开头连续排列的已完成章节可以原地保留
+    prefix = 0
+    prefix_end = manifest['book']['header_length'] if manifest else None
+    while prefix in kept and kept[prefix]['offset'] == prefix_end:
+        prefix_end += kept[prefix]['length']
+        prefix += 1
+    rebuild = any(position >= prefix for position in kept)
+    
+    if rebuild:
+        # 中间存在缺失章节，写入新文件，已完成的章节从旧文件复制
+        write_file = output_file + '.part'
+        write_manifest = manifest_file + '.part'
+        header_length = manifest['book']['header_length']
+        async with aiofiles.open(output_file, 'rb') as src, aiofiles.open(write_file, 'wb') as dst:
+            await dst.write(await src.read(header_length))
+        start_manifest(write_manifest, manifest['book'])
+        writer = ChapterWriter(write_file, write_manifest, CONFIG["write_buffer_size"], CONFIG["fsync_interval"],
+                               source_file=output_file)
+        for position, record in kept.items():
+            await writer.add_existing(position, chapters[position], record)
+        todo = [(position, chapter) for position, chapter in enumerate(chapters) if position not in kept]
+    else:
+        # 只有末尾缺失，截掉未记录的尾部后继续追加
+        if prefix_end is not None and os.path.exists(output_file) and os.path.getsize(output_file) > prefix_end:
+            os.truncate(output_file, prefix_end)
+        if manifest:
+            trim_manifest_tail(manifest_file)
+        writer = ChapterWriter(output_file, manifest_file, CONFIG["write_buffer_size"], CONFIG["fsync_interval"],
+                               start_index=prefix)
+        todo = list(enumerate(chapters))[prefix:]
+    
+    downloaded = len(kept)
+    # 记录正在写入的清单，流式阅读据此跟读（重建时为 .part 文件）
+    task_store.update(task_id, failed_chapters=0, write_manifest=writer.manifest_file)
+    if downloaded:
+        logger.info(f"已完成 {downloaded} 章，继续下载剩余 {len(todo)} 章")
+    
+    # 按官方接口批量大小分组，由 max_workers 个工作协程持续拉取，保持请求在途
+    batches = split_batches(todo)
+    work_queue = asyncio.Queue()
+    for batch in batches:
+        work_queue.put_nowait(batch)
+    finished = asyncio.Queue()
+    
+    async def worker():
+        while not is_stop_requested(task_id):
             try:
-                chapter_title, content = await task
-                if content:
-                    async with aiofiles.open(output_file, 'a', encoding='utf-8') as f:
-                        if chapter_title:
-                            await f.write(f'{chapter["title"]} {chapter_title}\n')
-                        else:
-                            await f.write(f'{chapter["title"]}\n')
-                        await f.write(content + '\n\n')
-                    
-                    downloaded += 1
-                    progress = int((downloaded / total_chapters) * 100)
-                    download_tasks[task_id].update({
-                        'progress': progress,
-                        'message': f'正在下载: {downloaded}/{total_chapters} 章'
-                    })
-                else:
-                    logger.error(f"章节 {chapter['title']} 下载失败")
+                batch = work_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            try:
+                # 组内的每个上游请求都要先从进程级配额中领取名额
+                results = await async_down_batch(session, [chapter["id"] for _, chapter in batch], headers, task_id)
             except Exception as e:
                 logger.error(f"处理章节失败: {str(e)}")
-
-async def async_download_novel(book_id: str, task_id: str):
-    """异步下载小说"""
+                results = {}
+            await finished.put((batch, results))
+        # 通知主循环该工作协程已退出
+        await finished.put(None)
+    
+    def report_progress():
+        message = f'正在下载: {downloaded + writer.written}/{total_chapters} 章'
+        if writer.failed:
+            message += f'，失败 {len(writer.failed)} 章'
+        task_store.update(
+            task_id,
+            progress=int(((downloaded + writer.written) / total_chapters) * 100),
+            message=message,
+            total_chapters=total_chapters,
+            failed_chapters=len(writer.failed)
+        )
+    
+    # 写入器负责乱序章节的重排、缓冲写入、清单记录和检查点同步
+    await writer.open()
+    last_report = 0.0
     try:
-        async with aiohttp.ClientSession() as session:
-            headers = await async_get_headers()
+        workers = [asyncio.create_task(worker()) for _ in range(min(CONFIG["max_workers"], len(batches)))]
+        active_workers = len(workers)
+        while active_workers:
+            item = await finished.get()
+            if item is None:
+                active_workers -= 1
+                continue
+            batch, results = item
+            for position, chapter in batch:
+                chapter_title, content = results.get(str(chapter["id"]), (None, None))
+                await writer.add(position, chapter, chapter_title, content)
             
-            # 获取章节列表
+            # 进度写入共享存储，按最小间隔合并
+            if time.monotonic() - last_report >= CONFIG["progress_interval"]:
+                last_report = time.monotonic()
+                report_progress()
+    finally:
+        await writer.close()
+        if rebuild:
+            os.replace(write_file, output_file)
+            os.replace(write_manifest, manifest_file)
+    report_progress()
+    
+    # 工作协程因停止请求提前退出时还有未领取的分组，已完成的章节都已记录在清单中
+    if not work_queue.empty():
+        logger.info(f"任务 {task_id} 被用户停止")
+        task_store.update(
+            task_id,
+            status='stopped',
+            message='下载已停止'
+        )
+        return writer.written, False
+    return writer.written, True
+
+async def async_download_novel(book_id: str, task_id: str, session: Optional[aiohttp.ClientSession] = None,
+                               update: bool = False):
+    """异步下载小说，update 为 True 时只下载已有内容之后新增的章节"""
+    try:
+        # 使用下载引擎的共享连接池
+        session = session or download_engine.session
+        headers = await async_get_headers()
+        
+        # 章节列表和书籍信息同时请求，更新模式沿用清单中的书籍信息
+        book_info = None if update else asyncio.ensure_future(async_get_book_info(session, book_id, headers))
+        with metrics.timer('fanqie_stage_seconds', stage='directory'):
             chapters = await async_get_chapters(session, book_id, headers)
-            if not chapters:
-                download_tasks[task_id].update({
-                    'status': 'error',
-                    'message': '未找到任何章节，请检查小说ID是否正确。'
-                })
+        if not chapters:
+            if book_info:
+                book_info.cancel()
+            task_store.update(
+                task_id,
+                status='error',
+                message='未找到任何章节，请检查小说ID是否正确。'
+            )
+            return
+            
+        manifest = load_manifest(book_id)
+        if update:
+            # 更新模式直接沿用已下载的书籍信息和输出文件，不再请求书籍页面
+            if not manifest or not os.path.exists(manifest['book']['output_file']):
+                task_store.update(
+                    task_id,
+                    status='error',
+                    message='未找到已下载的内容，请先完整下载该小说。'
+                )
                 return
-                
+            output_file = manifest['book']['output_file']
+        else:
             # 获取书籍信息
-            name, author_name, description = await async_get_book_info(session, book_id, headers)
+            name, author_name, description = await book_info
             if not name:
                 name = f"未知小说_{book_id}"
                 author_name = "未知作者"
@@ -528,43 +2420,195 @@ async def async_download_novel(book_id: str, task_id: str):
             # 准备下载
             output_file = os.path.join(save_path, f"{name}.txt")
             
-            # 检查是否需要继续下载
-            progress = load_progress(book_id)
-            if not progress:
+            # 没有可用的章节清单时重新开始
+            if not manifest or manifest['book'].get('output_file') != output_file or not os.path.exists(output_file):
                 # 写入书籍信息
-                async with aiofiles.open(output_file, 'w', encoding='utf-8') as f:
-                    await f.write(f"小说名: {name}\n作者: {author_name}\n内容简介: {description}\n\n")
-            
-            # 下载章节
-            await async_download_chapters(session, chapters, headers, output_file, task_id, book_id)
-            
-            # 更新任务状态
-            if task_id in download_controls and download_controls[task_id]['stop']:
-                return
-                
-            download_tasks[task_id].update({
-                'status': 'completed',
-                'progress': 100,
-                'message': '下载完成',
-                'file_path': output_file
-            })
-            
-            # 下载完成后删除进度文件
-            progress_file = os.path.join('downloads', f"{book_id}_progress.json")
-            if os.path.exists(progress_file):
-                os.remove(progress_file)
+                header = f"小说名: {name}\n作者: {author_name}\n内容简介: {description}\n\n".encode('utf-8')
+                async with aiofiles.open(output_file, 'wb') as f:
+                    await f.write(header)
+                start_manifest(get_manifest_file(book_id), {
+                    'output_file': output_file,
+                    'name': name,
+                    'author': author_name,
+                    'description': description,
+                    'header_length': len(header),
+                    'created_at': time.time()
+                })
+        
+        # 下载章节
+        new_chapters, finished = await async_download_chapters(session, chapters, headers, output_file, task_id, book_id)
+        
+        # 更新任务状态
+        if not finished:
+            return
             
+        failed_chapters = task_store.get(task_id).get('failed_chapters', 0)
+        message = f'更新完成，新增 {new_chapters} 章' if update else '下载完成'
+        if failed_chapters:
+            message += f'，{failed_chapters} 章下载失败'
+        await index_book(book_id, output_file)
+        task_store.update(
+            task_id,
+            status='completed',
+            progress=100,
+            message=message,
+            new_chapters=new_chapters,
+            file_path=output_file
+        )
+        # 高压缩级别耗时较长，完成后在后台生成副本，期间下载直接发送原文件
+        download_engine.submit(compress_book(output_file))
+        
     except Exception as e:
         logger.error(f"下载小说失败: {str(e)}")
-        download_tasks[task_id].update({
-            'status': 'error',
-            'message': f'下载出错: {str(e)}'
+        task_store.update(
+            task_id,
+            status='error',
+            message=f'下载出错: {str(e)}'
+        )
+    finally:
+        metrics.inc('fanqie_downloads_total', result=task_store.get(task_id)['status'])
+
+def download_novel(book_id: str, task_id: str, update: bool = False):
+    """将下载任务提交到下载引擎的调度器排队"""
+    priority = CONFIG["scheduler"]["priorities"]["update" if update else "full"]
+    return download_engine.submit(download_scheduler.enqueue(task_id, book_id, update, priority))
+
+def start_or_attach(task_id: str):
+    """同一本书已有下载在进行时合并到该下载，否则提交新的下载"""
+    with task_store.transaction() as conn:
+        task = task_store.get(task_id, conn)
+        job = task_store.find_running_job(task['book_id'], conn)
+        if job and job['task_id'] != task_id:
+            task_store.update(task_id, conn, status=job['status'], attached_to=job['task_id'], subscribed=1)
+            # 正在停止的下载有了新的订阅者，撤销停止请求
+            task_store.update(job['task_id'], conn, stop_requested=0)
+        else:
+            job = None
+            task_store.update(task_id, conn, status='queued', attached_to=None, subscribed=1,
+                              stop_requested=0, owner=get_owner(), write_manifest=None)
+    
+    if job:
+        logger.info(f"任务 {task_id} 合并到正在进行的任务 {job['task_id']}")
+        return
+    download_novel(task['book_id'], task_id, update=(task.get('mode') == 'update'))
+
+def create_download_task(book_id: str, mode: str = 'full') -> str:
+    """创建下载任务记录并提交下载"""
+    with task_store.transaction() as conn:
+        task_id = str(int(time.time() * 1000))
+        while task_store.get(task_id, conn):
+            task_id = str(int(task_id) + 1)
+        task_store.create(task_id, book_id, mode, '开始下载...' if mode == 'full' else '检查更新...', conn)
+    
+    # 提交到下载引擎
+    start_or_attach(task_id)
+    return task_id
+
+def create_batch(book_ids: List[str], mode: str = 'full') -> tuple:
+    """为每本书创建任务记录，返回 (批次ID, 任务ID列表)；重复的书籍ID只保留一个"""
+    book_ids = list(dict.fromkeys(book_ids))
+    task_ids = []
+    with task_store.transaction() as conn:
+        batch_id = task_id = str(int(time.time() * 1000))
+        for book_id in book_ids:
+            while task_store.get(task_id, conn):
+                task_id = str(int(task_id) + 1)
+            task_store.create(task_id, book_id, mode, '排队中...', conn)
+            task_store.update(task_id, conn, status='queued', owner=get_owner(), batch_id=batch_id)
+            task_ids.append(task_id)
+    return batch_id, task_ids
+
+async def async_download_batch(batch_id: str, task_ids: List[str], concurrency: int) -> dict:
+    """批量下载：每本书经调度器排队，受 max_active_jobs 和请求配额限制；同时最多 concurrency 本进入调度队列，结束后写出汇总报告"""
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run(task_id: str):
+        async with semaphore:
+            with task_store.transaction() as conn:
+                task = task_store.get(task_id, conn)
+                if task['status'] != 'queued':
+                    # 排队期间已被停止
+                    return
+                job = task_store.find_running_job(task['book_id'], conn)
+                if job and job['task_id'] != task_id:
+                    task_store.update(task_id, conn, status=job['status'], attached_to=job['task_id'],
+                                      started_at=time.time())
+                else:
+                    job = None
+            if job:
+                # 同一本书已在其他任务中下载，等待该下载结束
+                while get_task_view(task_id)['status'] in ('queued', 'running'):
+                    await asyncio.sleep(1)
+            else:
+                update = task['mode'] == 'update'
+                priority = CONFIG["scheduler"]["priorities"]["update" if update else "full"]
+                await (await download_scheduler.enqueue(task_id, task['book_id'], update, priority))
+            task_store.update(task_id, finished_at=time.time())
+    
+    await asyncio.gather(*(run(task_id) for task_id in task_ids))
+    report = batch_report(batch_id)
+    try:
+        report_dir = CONFIG["batch"]["report_dir"]
+        os.makedirs(report_dir, exist_ok=True)
+        async with aiofiles.open(os.path.join(report_dir, f"{batch_id}.json"), 'w', encoding='utf-8') as f:
+            await f.write(json.dumps(report, ensure_ascii=False, indent=2))
+    except Exception as e:
+        logger.error(f"写入批量下载报告失败: {str(e)}")
+    return report
+
+def batch_report(batch_id: str) -> Optional[dict]:
+    """批量下载的汇总：每本书的耗时、章节数和失败章节数"""
+    tasks = task_store.list_batch(batch_id)
+    if not tasks:
+        return None
+    books = []
+    for task in tasks:
+        view = get_task_view(task['task_id'])
+        started, finished = task.get('started_at'), task.get('finished_at')
+        books.append({
+            'book_id': view['book_id'],
+            'task_id': view['task_id'],
+            'name': os.path.splitext(os.path.basename(view['file_path']))[0] if view.get('file_path') else None,
+            'status': view['status'],
+            'message': view.get('message'),
+            'seconds': round((finished or time.time()) - started, 2) if started else None,
+            'chapters': view.get('total_chapters', 0),
+            'failed_chapters': view.get('failed_chapters', 0)
         })
+    statuses = [book['status'] for book in books]
+    finished_at = [task['finished_at'] for task in tasks if task.get('finished_at')]
+    done = all(status not in ('queued', 'running') for status in statuses)
+    return {
+        'batch_id': batch_id,
+        'finished': done,
+        'seconds': round((max(finished_at) if done and finished_at else time.time()) - tasks[0]['created_at'], 2),
+        'books': len(books),
+        'completed': statuses.count('completed'),
+        'errors': statuses.count('error'),
+        'stopped': statuses.count('stopped'),
+        'chapters': sum(book['chapters'] for book in books),
+        'failed_chapters': sum(book['failed_chapters'] for book in books),
+        'results': books
+    }
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-def download_novel(book_id: str, task_id: str):
-    """启动异步下载任务"""
-    download_controls[task_id] = {'stop': False}
-    asyncio.run(async_download_novel(book_id, task_id))
+@app.teardown_appcontext
+def release_task_db(exception):
+    """请求（包括流式响应）结束后归还任务数据库连接"""
+    for store, conn in g.pop('task_db', {}).items():
+        store.release(conn)
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'not_found'
+    metrics.inc('fanqie_http_requests_total', endpoint=endpoint, status=str(response.status_code))
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        metrics.observe('fanqie_http_request_seconds', time.perf_counter() - started, endpoint=endpoint)
+    return response
 
 @app.route('/')
 def home():
@@ -577,33 +2621,391 @@ def start_download():
         return jsonify({'error': '请输入小说ID'}), 400
     
     # 创建下载任务
-    task_id = str(int(time.time()))
-    download_tasks[task_id] = {
-        'status': 'running',
-        'progress': 0,
-        'message': '开始下载...',
-        'book_id': book_id,
-        'created_at': time.time()
-    }
+    task_id = create_download_task(book_id)
+    return jsonify({'task_id': task_id})
+
+@app.route('/batch_download', methods=['POST'])
+def batch_download():
+    """批量提交下载，book_ids 为 JSON 数组，或表单中以空白、逗号分隔的书籍ID"""
+    data = request.get_json(silent=True) or request.form
+    book_ids = data.get('book_ids') or []
+    if isinstance(book_ids, str):
+        book_ids = re.split(r'[\s,，]+', book_ids)
+    book_ids = [str(book_id).strip() for book_id in book_ids if str(book_id).strip()]
+    if not book_ids:
+        return jsonify({'error': '请输入小说ID'}), 400
+    if len(book_ids) > CONFIG["batch"]["max_books"]:
+        return jsonify({'error': f'单次最多提交 {CONFIG["batch"]["max_books"]} 本小说'}), 400
+    mode = data.get('mode', 'full')
+    if mode not in ('full', 'update'):
+        return jsonify({'error': '下载模式不正确'}), 400
+    try:
+        concurrency = max(1, int(data.get('concurrency') or CONFIG["batch"]["concurrency"]))
+    except (TypeError, ValueError):
+        return jsonify({'error': '并发数不正确'}), 400
+    
+    batch_id, task_ids = create_batch(book_ids, mode)
+    download_engine.submit(async_download_batch(batch_id, task_ids, concurrency))
+    return jsonify({'batch_id': batch_id, 'task_ids': task_ids})
+
+@app.route('/batch_status/<batch_id>')
+def batch_status(batch_id):
+    """批量下载的进度和汇总报告"""
+    report = batch_report(batch_id)
+    if report is None:
+        return jsonify({'error': '批次不存在'}), 404
+    return jsonify(report)
+
+@app.route('/update_download', methods=['POST'])
+def update_download():
+    """增量更新已下载的小说，只下载新增章节"""
+    book_id = request.form.get('book_id')
+    if not book_id:
+        return jsonify({'error': '请输入小说ID'}), 400
     
-    # 启动下载线程
-    thread = Thread(target=download_novel, args=(book_id, task_id))
-    thread.start()
+    if not load_manifest(book_id):
+        return jsonify({'error': '该小说尚未下载，请先完整下载'}), 400
     
+    task_id = create_download_task(book_id, mode='update')
     return jsonify({'task_id': task_id})
 
 @app.route('/download_status/<task_id>')
 def download_status(task_id):
-    if task_id not in download_tasks:
+    task = get_task_view(task_id)
+    if task is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(task)
+
+class TaskWatcher:
+    """每个进程中每个任务一个监视器：由一个线程轮询任务状态和正在写入的章节清单大小，
+    推送和流式连接阻塞在共享的条件变量上等待变化，连接数增加不会增加数据库查询"""
+
+    def __init__(self, task_id: str, poll_interval: float):
+        self.task_id = task_id
+        self.poll_interval = poll_interval
+        self.version = 0
+        self.view = None
+        self.manifest_size = None
+        self.readers = 0
+        # 在请求中创建，gevent 工作进程中使用的是打过补丁的协作式条件变量
+        self._cond = threading.Condition()
+
+    def _poll(self) -> tuple:
+        view = get_task_view(self.task_id)
+        size = None
+        if view and view.get('write_manifest'):
+            try:
+                size = os.path.getsize(view['write_manifest'])
+            except OSError:
+                pass
+        return view, size
+
+    def run(self):
+        while True:
+            version = change_notifier.version
+            try:
+                view, size = self._poll()
+            except Exception as e:
+                logger.error(f"读取任务状态失败: {str(e)}")
+                change_notifier.wait(version, self.poll_interval)
+                continue
+            with self._cond:
+                if self.version == 0 or (view, size) != (self.view, self.manifest_size):
+                    self.view, self.manifest_size = view, size
+                    self.version += 1
+                    self._cond.notify_all()
+            with task_watchers_lock:
+                # 没有连接或任务已结束时退出，之后的连接会创建新的监视器
+                if not self.readers or view is None or view['status'] not in ('queued', 'running'):
+                    if task_watchers.get(self.task_id) is self:
+                        del task_watchers[self.task_id]
+                    return
+            change_notifier.wait(version, self.poll_interval)
+
+    def wait(self, version: int, timeout: float) -> int:
+        """等待版本号不同于 version 或超时，返回当前版本号"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+task_watchers: Dict[str, TaskWatcher] = {}
+task_watchers_lock = Lock()
+
+@contextmanager
+def watch_task(task_id: str):
+    """登记一个连接并返回该任务的监视器，需要时启动监视线程"""
+    with task_watchers_lock:
+        watcher = task_watchers.get(task_id)
+        start = watcher is None
+        if start:
+            watcher = task_watchers[task_id] = TaskWatcher(task_id, CONFIG["events"]["poll_interval"])
+        watcher.readers += 1
+    if start:
+        threading.Thread(target=watcher.run, name=f'task-watcher-{task_id}', daemon=True).start()
+    try:
+        yield watcher
+    finally:
+        with task_watchers_lock:
+            watcher.readers -= 1
+
+@app.route('/download_events/<task_id>')
+def download_events(task_id):
+    """以 Server-Sent Events 推送任务状态，状态变化时才发送，推送频率不超过 events.min_interval"""
+    if get_task_view(task_id) is None:
         return jsonify({'error': '任务不存在'}), 404
-    return jsonify(download_tasks[task_id])
+    settings = CONFIG["events"]
+    
+    def generate():
+        yield 'retry: 2000\n\n'
+        started = sent_at = time.monotonic()
+        last_view = None
+        version = 0
+        with watch_task(task_id) as watcher:
+            while time.monotonic() - started < settings["max_duration"]:
+                version = watcher.wait(version, settings["keepalive"])
+                view = watcher.view
+                if view is None:
+                    break
+                if view != last_view:
+                    yield f'data: {json.dumps(view, ensure_ascii=False)}\n\n'
+                    last_view = view
+                    sent_at = time.monotonic()
+                    if view['status'] in ('completed', 'error', 'stopped'):
+                        break
+                    # 间隔期间的变化在下次等待时立即返回，合并为一次推送
+                    time.sleep(settings["min_interval"])
+                elif time.monotonic() - sent_at >= settings["keepalive"]:
+                    yield ': keepalive\n\n'
+                    sent_at = time.monotonic()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def follow_book(task_id: str, book_id: str):
+    """按章节清单跟读正在写入的文件，只输出清单中已记录的完整章节，任务结束且读完后退出"""
+    settings = CONFIG["stream"]
+    timeout = CONFIG["events"]["keepalive"]
+    manifest_file = get_manifest_file(book_id)
+    
+    with watch_task(task_id) as watcher:
+        # 等待任务开始写入；中间有缺失章节时任务在 .part 文件中按顺序重建，跟读重建中的文件
+        version = 0
+        while True:
+            version = watcher.wait(version, timeout)
+            view = watcher.view
+            if view is None:
+                return
+            if view['status'] not in ('queued', 'running'):
+                break
+            if view.get('write_manifest') and os.path.exists(view['write_manifest']):
+                manifest_file = view['write_manifest']
+                break
+        if not os.path.exists(manifest_file):
+            return
+        
+        with open(manifest_file, 'r', encoding='utf-8') as manifest:
+            book = json.loads(manifest.readline())
+            output_file = book['output_file'] + ('.part' if manifest_file.endswith('.part') else '')
+            with open(output_file, 'rb') as f:
+                sent = 0
+                committed = book['header_length']
+                pending_line = ''
+                finished = False
+                while True:
+                    # 读取清单新增的行，末行可能还没写完整
+                    for line in manifest.readlines():
+                        if not line.endswith('\n'):
+                            pending_line += line
+                            continue
+                        record = json.loads(pending_line + line)
+                        pending_line = ''
+                        committed = max(committed, record['offset'] + record['length'])
+                    while sent < committed:
+                        f.seek(sent)
+                        chunk = f.read(min(settings["chunk_size"], committed - sent))
+                        if not chunk:
+                            break
+                        sent += len(chunk)
+                        yield chunk
+                    if finished:
+                        return
+                    view = watcher.view
+                    if view is None or view['status'] not in ('queued', 'running'):
+                        # 任务结束后再读一次清单，把最后写出的章节发完
+                        finished = True
+                        continue
+                    # 监视器发现清单变长或任务状态变化时返回
+                    version = watcher.wait(version, timeout)
+
+@app.route('/download_stream/<task_id>')
+def download_stream(task_id):
+    """边下载边阅读：立即开始发送已写出的章节，并随写入持续输出后续章节直到任务结束"""
+    task = get_task_view(task_id)
+    if task is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if task['status'] not in ('queued', 'running') and not os.path.exists(get_manifest_file(task['book_id'])):
+        return jsonify({'error': '未找到下载进度'}), 404
+    return Response(
+        stream_with_context(follow_book(task_id, task['book_id'])),
+        mimetype='text/plain; charset=utf-8',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+class ZipSink:
+    """供 zipfile 写入的内存缓冲，每个条目写完后取走数据；
+    条目写入期间支持回写本条目的文件头，生成的归档不需要数据描述符"""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._base = 0  # 已取走的字节数
+
+    def write(self, data) -> int:
+        return self._buffer.write(data)
+
+    def tell(self) -> int:
+        return self._base + self._buffer.tell()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence != 0 or offset < self._base:
+            raise OSError('只能在当前条目内定位')
+        return self._base + self._buffer.seek(offset - self._base)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = self._buffer.getvalue()
+        self._base += len(data)
+        self._buffer = io.BytesIO()
+        return data
+
+def iter_stored_chapters(manifest: dict):
+    """按章节顺序逐章读取已写入文件的章节，返回 (序号, 标题, 正文行)，不把整本书读入内存"""
+    records = sorted(manifest['chapters'].values(), key=lambda record: record['index'])
+    with open(manifest['book']['output_file'], 'rb') as f:
+        for number, record in enumerate(records, 1):
+            f.seek(record['offset'])
+            lines = f.read(record['length']).decode('utf-8', errors='replace').split('\n')
+            yield number, lines[0].strip() or record['title'], [line.strip() for line in lines[1:] if line.strip()]
+
+# XML 1.0 不允许的控制字符
+XML_INVALID_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def xml_text(text: str) -> str:
+    return escape(XML_INVALID_RE.sub('', text), quote=True)
+
+def xhtml_page(title: str, body: str) -> str:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+        'lang="zh-CN" xml:lang="zh-CN">\n'
+        f'<head><meta charset="utf-8"/><title>{xml_text(title)}</title></head>\n<body>\n{body}</body>\n</html>\n'
+    )
+
+def export_epub(book_id: str, manifest: dict):
+    """逐章生成 EPUB 3（附 NCX 目录兼容旧阅读器），边生成边输出，内存占用与书的大小无关"""
+    book = manifest['book']
+    name, author, description = book.get('name') or book_id, book.get('author') or '', book.get('description') or ''
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        # mimetype 必须是第一个且不压缩的条目
+        zf.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        zf.writestr('META-INF/container.xml', (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+            '</container>\n'
+        ))
+        paragraphs = ''.join(f'<p>{xml_text(line.strip())}</p>\n' for line in description.split('\n') if line.strip())
+        zf.writestr('OEBPS/text/intro.xhtml', xhtml_page(name, (
+            f'<h1>{xml_text(name)}</h1>\n<p>作者：{xml_text(author)}</p>\n{paragraphs}'
+        )))
+        yield sink.drain()
+        
+        titles = []
+        for number, title, lines in iter_stored_chapters(manifest):
+            titles.append(title)
+            body = f'<h2>{xml_text(title)}</h2>\n' + ''.join(f'<p>{xml_text(line)}</p>\n' for line in lines)
+            zf.writestr(f'OEBPS/text/{number:05d}.xhtml', xhtml_page(title, body))
+            yield sink.drain()
+        
+        # 目录和包文件在所有章节之后写出，只需保留章节标题
+        with zf.open('OEBPS/nav.xhtml', 'w') as f:
+            f.write(xhtml_page('目录', '<nav epub:type="toc" id="toc"><h1>目录</h1>\n<ol>\n' + ''.join(
+                f'<li><a href="text/{number:05d}.xhtml">{xml_text(title)}</a></li>\n'
+                for number, title in enumerate(titles, 1)
+            ) + '</ol></nav>\n').encode('utf-8'))
+        yield sink.drain()
+        with zf.open('OEBPS/toc.ncx', 'w') as f:
+            f.write((
+                '<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+                f'<head><meta name="dtb:uid" content="urn:fanqie:{xml_text(book_id)}"/></head>\n'
+                f'<docTitle><text>{xml_text(name)}</text></docTitle>\n<navMap>\n'
+            ).encode('utf-8'))
+            for number, title in enumerate(titles, 1):
+                f.write((
+                    f'<navPoint id="p{number}" playOrder="{number}"><navLabel><text>{xml_text(title)}</text></navLabel>'
+                    f'<content src="text/{number:05d}.xhtml"/></navPoint>\n'
+                ).encode('utf-8'))
+            f.write('</navMap>\n</ncx>\n'.encode('utf-8'))
+        yield sink.drain()
+        with zf.open('OEBPS/content.opf', 'w') as f:
+            modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(os.path.getmtime(book['output_file'])))
+            f.write((
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="zh-CN">\n'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+                f'<dc:identifier id="book-id">urn:fanqie:{xml_text(book_id)}</dc:identifier>\n'
+                f'<dc:title>{xml_text(name)}</dc:title>\n<dc:creator>{xml_text(author)}</dc:creator>\n'
+                f'<dc:description>{xml_text(description)}</dc:description>\n<dc:language>zh-CN</dc:language>\n'
+                f'<meta property="dcterms:modified">{modified}</meta>\n</metadata>\n<manifest>\n'
+                '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+                '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>\n'
+                '<item id="intro" href="text/intro.xhtml" media-type="application/xhtml+xml"/>\n'
+            ).encode('utf-8'))
+            for number in range(1, len(titles) + 1):
+                f.write(f'<item id="c{number}" href="text/{number:05d}.xhtml" media-type="application/xhtml+xml"/>\n'.encode('utf-8'))
+            f.write('</manifest>\n<spine toc="ncx">\n<itemref idref="intro"/>\n'.encode('utf-8'))
+            for number in range(1, len(titles) + 1):
+                f.write(f'<itemref idref="c{number}"/>\n'.encode('utf-8'))
+            f.write('</spine>\n</package>\n'.encode('utf-8'))
+        yield sink.drain()
+    yield sink.drain()
+
+def export_zip(book_id: str, manifest: dict):
+    """逐章生成分章节 TXT 的 ZIP 归档，边生成边输出"""
+    book = manifest['book']
+    name = book.get('name') or book_id
+    # 书名来自上游页面，与章节标题同样处理，并去掉开头的点，避免 .. 跳出归档目录
+    dirname = re.sub(r'[\\/:*?"<>|]', '_', name).lstrip('. ')[:80] or book_id
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f'{dirname}/0000 简介.txt', (
+            f"小说名: {name}\n作者: {book.get('author') or ''}\n内容简介: {book.get('description') or ''}\n"
+        ))
+        yield sink.drain()
+        for number, title, lines in iter_stored_chapters(manifest):
+            # 标题中的路径分隔符会在解压时生成目录
+            filename = re.sub(r'[\\/:*?"<>|]', '_', title)[:80]
+            zf.writestr(f'{dirname}/{number:04d} {filename}.txt', title + '\n' + '\n'.join('    ' + line for line in lines) + '\n')
+            yield sink.drain()
+    yield sink.drain()
+
+# 导出格式：(生成函数, MIME 类型, 扩展名)
+EXPORT_FORMATS = {
+    'epub': (export_epub, 'application/epub+zip', '.epub'),
+    'zip': (export_zip, 'application/zip', '.zip')
+}
 
 @app.route('/download_file/<task_id>')
 def download_file(task_id):
-    if task_id not in download_tasks:
+    task = get_task_view(task_id)
+    if task is None:
         return jsonify({'error': '任务不存在'}), 404
     
-    task = download_tasks[task_id]
     if task['status'] != 'completed':
         return jsonify({'error': '下载尚未完成'}), 400
     
@@ -612,16 +3014,109 @@ def download_file(task_id):
         return jsonify({'error': '文件不存在'}), 404
     
     try:
-        return send_file(
-            file_path,
+        # 按 Accept-Encoding 选择预压缩副本，权重相同时按配置顺序
+        encoding, path = None, file_path
+        candidates = [e for e in available_encodings() if request.accept_encodings.quality(e) > 0]
+        candidates.sort(key=lambda e: -request.accept_encodings.quality(e))
+        for candidate in candidates:
+            sidecar = sidecar_path(file_path, candidate)
+            if sidecar:
+                encoding, path = candidate, sidecar
+                break
+        else:
+            if candidates:
+                # 旧任务没有副本或副本已过期，后台补生成，本次先发送原文件
+                download_engine.submit(compress_book(file_path))
+        
+        # conditional 处理 ETag/Last-Modified 协商和 Range 断点续传
+        response = send_file(
+            path,
             as_attachment=True,
             download_name=os.path.basename(file_path),
-            mimetype='text/plain; charset=utf-8'
+            mimetype='text/plain; charset=utf-8',
+            conditional=True,
+            etag=True,
+            last_modified=os.path.getmtime(file_path)
         )
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.vary.add('Accept-Encoding')
+        return response
+    except RequestedRangeNotSatisfiable as e:
+        return e
     except Exception as e:
         logger.error(f"文件下载失败: {str(e)}")
         return jsonify({'error': '文件下载失败'}), 500
 
+@app.route('/export/<task_id>')
+def export_book(task_id):
+    """从已下载的章节导出 EPUB 或分章节 ZIP，不重新下载，边生成边发送"""
+    task = get_task_view(task_id)
+    if task is None:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    if task['status'] != 'completed':
+        return jsonify({'error': '下载尚未完成'}), 400
+    
+    export_format = request.args.get('format', 'epub')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': '不支持的导出格式'}), 400
+    
+    manifest = load_manifest(task['book_id'])
+    if not manifest or not os.path.exists(manifest['book']['output_file']):
+        return jsonify({'error': '文件不存在'}), 404
+    
+    generate, mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = os.path.splitext(os.path.basename(manifest['book']['output_file']))[0] + extension
+    return Response(
+        stream_with_context(generate(task['book_id'], manifest)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"}
+    )
+
+@app.route('/chapter/<task_id>/<int:start>')
+def read_chapters(task_id, start):
+    """按章节序号（从 1 开始）读取单章，或以 end 参数读取到第 end 章（含）为止的连续章节"""
+    task = get_task_view(task_id)
+    if task is None:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    if task['status'] != 'completed':
+        return jsonify({'error': '下载尚未完成'}), 400
+    
+    file_path = task.get('file_path')
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': '文件不存在'}), 404
+    
+    end = request.args.get('end', start, type=int)
+    if end - start + 1 > CONFIG["chapter_index"]["max_range"]:
+        return jsonify({'error': f'单次最多读取 {CONFIG["chapter_index"]["max_range"]} 章'}), 400
+    
+    try:
+        index = get_chapter_index(task['book_id'], file_path)
+        if index is None:
+            return jsonify({'error': '未找到章节清单'}), 404
+        if not 1 <= start <= end <= len(index):
+            return jsonify({'error': '章节不存在', 'chapters': len(index)}), 404
+        
+        records = [index.record(position) for position in range(start - 1, end)]
+        # 章节按顺序连续存放，一次读出整个范围
+        first = records[0][0]
+        with open(file_path, 'rb') as f:
+            f.seek(first)
+            data = f.read(records[-1][0] + records[-1][1] - first)
+        
+        if request.args.get('format') == 'json':
+            return jsonify({'chapters': [
+                {'number': number, 'title': title, 'content': data[offset - first:offset - first + length].decode('utf-8', errors='replace')}
+                for number, (offset, length, title) in enumerate(records, start)
+            ], 'total': len(index)})
+        return Response(data, mimetype='text/plain; charset=utf-8', headers={'X-Total-Chapters': str(len(index))})
+    except Exception as e:
+        logger.error(f"读取章节失败: {str(e)}")
+        return jsonify({'error': '读取章节失败'}), 500
+
 @app.route('/stop_download/<task_id>', methods=['POST'])
 def stop_download_route(task_id):
     """停止下载的路由"""
@@ -632,53 +3127,62 @@ def stop_download_route(task_id):
 @app.route('/resume_download/<task_id>', methods=['POST'])
 def resume_download_route(task_id):
     """继续下载的路由"""
-    if task_id not in download_tasks:
+    view = get_task_view(task_id)
+    if view is None:
         return jsonify({'error': '任务不存在'}), 404
         
-    task = download_tasks[task_id]
-    if task['status'] != 'stopped':
+    if view['status'] != 'stopped':
         return jsonify({'error': '任务状态不正确'}), 400
         
-    # 重新启动下载
-    book_id = task['book_id']
-    download_controls[task_id]['stop'] = False
-    download_tasks[task_id].update({
-        'status': 'running',
-        'message': '继续下载...'
-    })
+    # 下载仍在为其他任务进行时重新订阅即可
+    with task_store.transaction() as conn:
+        task = task_store.get(task_id, conn)
+        job = task_store.get(task.get('attached_to') or task_id, conn)
+        resubscribe = job and job['status'] in ('queued', 'running') and owner_alive(job.get('owner'))
+        if resubscribe:
+            task_store.update(task_id, conn, subscribed=1)
+            task_store.update(job['task_id'], conn, stop_requested=0)
+        else:
+            task_store.update(task_id, conn, message='继续下载...')
     
-    # 启动下载线程
-    thread = Thread(target=download_novel, args=(book_id, task_id))
-    thread.start()
+    # 重新启动下载
+    if not resubscribe:
+        start_or_attach(task_id)
     
     return jsonify({'status': 'success', 'message': '继续下载'})
 
+@app.route('/cache_stats')
+def cache_stats():
+    """章节缓存命中情况"""
+    return jsonify(chapter_cache.stats())
+
+@app.route('/upstream_stats')
+def upstream_stats():
+    """本进程各上游端点的限速与熔断状态"""
+    return jsonify({name: guard.stats() for name, guard in list(endpoint_guards.items())})
+
+@app.route('/metrics')
+def metrics_route():
+    """Prometheus 格式的指标，汇总所有工作进程"""
+    return Response(metrics.collect(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/download_partial/<task_id>')
 def download_partial_file(task_id):
     """下载已完成章节的路由"""
-    if task_id not in download_tasks:
+    task = task_store.get(task_id)
+    if task is None:
         return jsonify({'error': '任务不存在'}), 404
         
-    task = download_tasks[task_id]
     book_id = task['book_id']
     
-    # 获取进度文件
-    progress = load_progress(book_id)
-    if not progress:
+    # 根据章节清单找到正在写入的文件
+    manifest = load_manifest(book_id)
+    if not manifest:
         return jsonify({'error': '未找到下载进度'}), 404
     
-    # 获取已下载的文件
-    save_path = os.path.join('downloads', book_id)
-    if not os.path.exists(save_path):
-        return jsonify({'error': '下载目录不存在'}), 404
-        
-    # 查找最新的txt文件
-    txt_files = [f for f in os.listdir(save_path) if f.endswith('.txt')]
-    if not txt_files:
+    file_path = manifest['book']['output_file']
+    if not os.path.exists(file_path):
         return jsonify({'error': '未找到下载文件'}), 404
-        
-    # 使用最新的文件
-    file_path = os.path.join(save_path, txt_files[-1])
     
     try:
         return send_file(
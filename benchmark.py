@@ -0,0 +1,370 @@
+"""
+番茄小说下载器 - 性能基准测试
+Copyright (C) 2024 fanqie-novel-downloader
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+用法：
+    python benchmark.py cpu [--batches 40] [--paragraphs 200]
+    python benchmark.py normalize [--chapters 300]
+    python benchmark.py e2e [--books 2 --chapters 1000] [--latency 0.05 --error-rate 0.01 --throttle 50] [--output result.json]
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+import app
+import fake_upstream
+
+
+def make_chapter_html(index: int, paragraphs: int) -> str:
+    """生成与官方接口结构一致的章节HTML"""
+    body = "".join(f'<p idx="{k}">第{index}章第{k}段，这是一段用于压测解密与清理的正文内容。</p>' for k in range(paragraphs))
+    return f"<header><div>header</div></header><article><p>第{index}章 标题{index}</p>{body}</article><footer>footer</footer>"
+
+
+def make_realistic_chapter(index: int, rng: random.Random) -> tuple:
+    """生成长度和结构接近真实数据的章节：官方接口带 header/footer，备用接口多为纯段落"""
+    paragraphs = []
+    for k in range(rng.randint(40, 120)):
+        text = "".join(rng.choice("他她说道我们你的了是在不有这一个来看着笑声音") for _ in range(rng.randint(20, 160)))
+        if k % 17 == 0:
+            text += "\\u003c"
+        paragraphs.append(f'<p idx="{k}">　　{text}</p>')
+    body = "".join(paragraphs)
+    title = f"标题{index}"
+    if index % 3:
+        return f'<header><div class="muye-reader-title">{title}</div></header><article><p>第{index}章 {title}</p>{body}</article><footer><a>下一章</a></footer>', title
+    return f"{title}\n{body}", title
+
+
+def legacy_clean_chapter_content(content: str, chapter_title) -> str:
+    """原先逐步调用 re.sub 的清理实现，作为输出格式的基准"""
+    content = re.sub(r'<header>.*?</header>', '', content, flags=re.DOTALL)
+    content = re.sub(r'<footer>.*?</footer>', '', content, flags=re.DOTALL)
+    content = re.sub(r'</?article>', '', content)
+    content = re.sub(r'<p[^>]*>', '\n    ', content)
+    content = re.sub(r'</p>', '', content)
+    content = re.sub(r'<[^>]+>', '', content)
+    content = re.sub(r'\\u003c|\\u003e', '', content)
+    if chapter_title and content.startswith(chapter_title):
+        content = content[len(chapter_title):].lstrip()
+    content = re.sub(r'\n{3,}', '\n\n', content).strip()
+    lines = [line.strip() for line in content.split('\n') if line.strip()]
+    return '\n'.join(['    ' + line for line in lines])
+
+
+def bench_normalize(args) -> dict:
+    """章节清理的单章耗时和峰值内存，先确认与原实现输出逐字一致"""
+    rng = random.Random(args.seed)
+    corpus = [make_realistic_chapter(i, rng) for i in range(args.chapters)]
+    mismatches = sum(app.clean_chapter_content(c, t) != legacy_clean_chapter_content(c, t) for c, t in corpus)
+
+    report = {"chapters": args.chapters, "avg_chapter_bytes": sum(len(c.encode()) for c, _ in corpus) // len(corpus),
+              "mismatches": mismatches}
+    for name, func in (("legacy", legacy_clean_chapter_content), ("current", app.clean_chapter_content)):
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for content, title in corpus:
+                func(content, title)
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        peaks = []
+        for content, title in corpus:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            func(content, title)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.stop()
+        report[name] = {
+            "us_per_chapter": round(elapsed / args.rounds / len(corpus) * 1e6, 1),
+            "peak_alloc_bytes": sum(peaks) // len(peaks)
+        }
+    return report
+
+
+def make_official_batches(batches: int, paragraphs: int, key: bytes) -> list:
+    """生成加密压缩后的官方接口批量返回数据"""
+    result = []
+    for b in range(batches):
+        data = {}
+        for i in range(b * app.OFFICIAL_BATCH_LIMIT, (b + 1) * app.OFFICIAL_BATCH_LIMIT):
+            iv = os.urandom(16)
+            raw = gzip.compress(make_chapter_html(i, paragraphs).encode('utf-8'))
+            content = base64.b64encode(iv + AES.new(key, AES.MODE_CBC, iv).encrypt(pad(raw, 16))).decode()
+            data[str(i)] = {"content": content, "title": f"第{i + 1}章 标题{i}"}
+        result.append(data)
+    return result
+
+
+def worker_counts(max_workers: int) -> list:
+    counts, n = [], 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    return counts + [max_workers]
+
+
+async def measure(work) -> tuple:
+    """执行 work 协程，同时记录事件循环的最大阻塞时间（影响同一循环上的网络I/O）"""
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal lag
+        while not done.is_set():
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.perf_counter() - before - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await work
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick
+    return elapsed, lag
+
+
+async def run_inline(batches: list, key: str):
+    for data in batches:
+        app.decode_official_contents(data, key)
+        await asyncio.sleep(0)
+
+
+async def run_pool(pool: app.CpuPool, batches: list, key: str):
+    await asyncio.gather(*(pool.run(app.decode_official_contents, data, key) for data in batches))
+
+
+def bench_cpu(args) -> dict:
+    """解密、解压和清理阶段在不同工作池配置下的吞吐"""
+    key = os.urandom(16)
+    batches = make_official_batches(args.batches, args.paragraphs, key)
+    chapters = args.batches * app.OFFICIAL_BATCH_LIMIT
+
+    inline, lag = asyncio.run(measure(run_inline(batches, key.hex())))
+    report = {
+        "cpu_count": os.cpu_count(),
+        "chapters": chapters,
+        "paragraphs": args.paragraphs,
+        "inline": {
+            "seconds": round(inline, 3),
+            "chapters_per_sec": round(chapters / inline, 1),
+            "max_loop_lag_ms": round(lag * 1000, 1)
+        },
+        "pools": []
+    }
+    for kind in args.kinds:
+        for workers in worker_counts(args.max_workers):
+            pool = app.CpuPool(kind, workers)
+            # 先预热，进程池的启动时间不计入吞吐
+            asyncio.run(run_pool(pool, batches[:workers], key.hex()))
+            elapsed, lag = asyncio.run(measure(run_pool(pool, batches, key.hex())))
+            pool.shutdown()
+            report["pools"].append({
+                "kind": kind,
+                "workers": workers,
+                "seconds": round(elapsed, 3),
+                "chapters_per_sec": round(chapters / elapsed, 1),
+                "speedup": round(inline / elapsed, 2),
+                "max_loop_lag_ms": round(lag * 1000, 1)
+            })
+    return report
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fetch_json(url: str, timeout: float = 5.0):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def start_upstream(settings: dict) -> tuple:
+    """在独立进程中启动模拟上游，返回 (进程, 地址)"""
+    port = free_port()
+    process = multiprocessing.get_context("spawn").Process(
+        target=fake_upstream.run, args=(port, settings, app.grk()), daemon=True)
+    process.start()
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            fetch_json(f"{base_url}/stats", timeout=1)
+            return process, base_url
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                process.terminate()
+                raise RuntimeError("模拟上游启动失败")
+            time.sleep(0.1)
+
+
+def bench_e2e(args) -> dict:
+    """用本地模拟上游端到端运行批量下载：章节吞吐、章节延迟分位数、上游请求数、CPU 和峰值内存"""
+    settings = {name: getattr(args, name) for name in fake_upstream.DEFAULT_SETTINGS}
+    process, base_url = start_upstream(settings)
+    workdir = tempfile.mkdtemp(prefix="fanqie-bench-")
+    cwd = os.getcwd()
+
+    # 下载目录、任务数据库和报告都放在临时目录；章节缓存会让重复运行直接命中，测试时关闭
+    os.chdir(workdir)
+    app.task_store = app.TaskStore(os.path.join(workdir, "tasks.db"))
+    app.CONFIG["chapter_cache"]["enabled"] = False
+    app.CONFIG["web_base_url"] = base_url
+    app.CONFIG["official_api"]["base_url"] = base_url
+    app.CONFIG["api_endpoints"] = [f"{base_url}/content?item_id={{chapter_id}}"]
+    if args.cpu_pool:
+        app.cpu_pool = app.CpuPool(args.cpu_pool, app.CONFIG["cpu_pool"]["workers"])
+
+    # 一组章节从发起请求到拿到清理后的正文的耗时，计入组内每一章
+    latencies = []
+    down_batch = app.async_down_batch
+
+    async def timed_down_batch(session, chapter_ids, headers, job_id=None):
+        started = time.perf_counter()
+        results = await down_batch(session, chapter_ids, headers, job_id)
+        latencies.extend([time.perf_counter() - started] * len(chapter_ids))
+        return results
+
+    app.async_down_batch = timed_down_batch
+    try:
+        book_ids = [str(i + 1) for i in range(args.books)]
+        batch_id, task_ids = app.create_batch(book_ids)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.perf_counter()
+        report = app.download_engine.run(app.async_download_batch(batch_id, task_ids, args.concurrency))
+        elapsed = time.perf_counter() - started
+        app.download_engine.stop()
+        app.cpu_pool.shutdown()
+        # 进程池的工作进程此时已退出，计入 RUSAGE_CHILDREN；模拟上游还在运行，不计入
+        end = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        upstream = fetch_json(f"{base_url}/stats")
+        requests = upstream["requests"]
+    finally:
+        app.async_down_batch = down_batch
+        process.terminate()
+        process.join()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    chapters = report["chapters"] - report["failed_chapters"]
+    return {
+        "commit": git_commit(),
+        "settings": dict(settings, books=args.books, concurrency=args.concurrency,
+                         cpu_pool=args.cpu_pool or app.CONFIG["cpu_pool"]["kind"]),
+        "books": report["books"],
+        "completed": report["completed"],
+        "chapters": chapters,
+        "failed_chapters": report["failed_chapters"],
+        "seconds": round(elapsed, 3),
+        "chapters_per_sec": round(chapters / elapsed, 1),
+        "chapter_latency_ms": {
+            "p50": round(percentile(latencies, 0.5) * 1000, 1),
+            "p90": round(percentile(latencies, 0.9) * 1000, 1),
+            "p99": round(percentile(latencies, 0.99) * 1000, 1),
+            "max": round(max(latencies, default=0.0) * 1000, 1)
+        },
+        "upstream_requests": dict(requests, total=sum(
+            count for route, count in requests.items() if route not in ("throttled", "errors"))),
+        # 模拟上游的生成和加密开销单独列出，不计入 cpu_seconds
+        "upstream_cpu_seconds": round(upstream["cpu_seconds"], 3),
+        "cpu_seconds": round(end.ru_utime + end.ru_stime - usage.ru_utime - usage.ru_stime
+                             + children.ru_utime + children.ru_stime, 3),
+        # Linux 上 ru_maxrss 的单位是 KB，包含导入 app 的开销
+        "peak_rss_mb": round(end.ru_maxrss / 1024, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="番茄小说下载器性能基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    cpu = sub.add_parser("cpu", help="章节解密、解压和清理的CPU吞吐")
+    cpu.add_argument("--batches", type=int, default=40, help="批次数，每批30章")
+    cpu.add_argument("--paragraphs", type=int, default=200, help="每章段落数")
+    cpu.add_argument("--kinds", nargs="+", default=["thread", "process"], choices=["thread", "process"])
+    cpu.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    cpu.set_defaults(func=bench_cpu)
+
+    normalize = sub.add_parser("normalize", help="章节清理的单章耗时和内存")
+    normalize.add_argument("--chapters", type=int, default=300)
+    normalize.add_argument("--rounds", type=int, default=5)
+    normalize.add_argument("--seed", type=int, default=1)
+    normalize.set_defaults(func=bench_normalize)
+
+    e2e = sub.add_parser("e2e", help="用本地模拟上游端到端下载的吞吐、延迟和资源占用")
+    e2e.add_argument("--books", type=int, default=2)
+    e2e.add_argument("--concurrency", type=int, default=app.CONFIG["batch"]["concurrency"], help="同时下载的书籍数")
+    e2e.add_argument("--cpu-pool", choices=["thread", "process"], help="默认使用 cpu_pool.kind 配置")
+    for name, value in fake_upstream.DEFAULT_SETTINGS.items():
+        option = "--" + name.replace("_", "-")
+        if name == "latency_dist":
+            e2e.add_argument(option, default=value, choices=["fixed", "exponential", "lognormal"])
+        else:
+            e2e.add_argument(option, type=type(value), default=value)
+    e2e.add_argument("-o", "--output", help="同时把结果写入文件，便于不同提交之间对比")
+    e2e.set_defaults(func=bench_e2e)
+
+    args = parser.parse_args()
+    report = args.func(args)
+    result = json.dumps(report, ensure_ascii=False, indent=2)
+    if getattr(args, "output", None):
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(result + "\n")
+    print(result)
+    # 清理输出与原实现不一致时以非零状态退出
+    if report.get("mismatches"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
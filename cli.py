@@ -0,0 +1,108 @@
+"""
+番茄小说下载器 - 命令行批量下载
+Copyright (C) 2024 fanqie-novel-downloader
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+用法：
+    python cli.py 7143038691944959011 7276384138653862966 [--concurrency 8]
+    python cli.py --file books.txt [--update] [--report report.json] [--export epub]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+import app
+
+
+def read_book_ids(args) -> list:
+    """合并命令行和书单文件中的书籍ID，书单中 # 开头的行为注释"""
+    book_ids = list(args.book_ids)
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.split('#', 1)[0]
+                book_ids.extend(part for part in re.split(r'[\s,，]+', line) if part)
+    return book_ids
+
+
+def export_books(report: dict, export_format: str):
+    """把下载完成的书导出到 TXT 文件旁边"""
+    generate, _, extension = app.EXPORT_FORMATS[export_format]
+    for book in report['results']:
+        manifest = app.load_manifest(book['book_id']) if book['status'] == 'completed' else None
+        if not manifest:
+            continue
+        path = os.path.splitext(manifest['book']['output_file'])[0] + extension
+        with open(path, 'wb') as f:
+            for chunk in generate(book['book_id'], manifest):
+                f.write(chunk)
+        print(f"已导出 {path}")
+
+
+def print_report(report: dict):
+    for book in report['results']:
+        seconds = f"{book['seconds']:.1f}s" if book['seconds'] is not None else '-'
+        print(f"{book['book_id']:<22}{book['status']:<11}{seconds:>9}{book['chapters']:>7} 章"
+              f"{book['failed_chapters']:>5} 失败  {book['name'] or book['message'] or ''}")
+    print(f"共 {report['books']} 本：完成 {report['completed']}，出错 {report['errors']}，停止 {report['stopped']}；"
+          f"{report['chapters']} 章，失败 {report['failed_chapters']} 章，用时 {report['seconds']:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="番茄小说批量下载")
+    parser.add_argument("book_ids", nargs="*", help="小说ID")
+    parser.add_argument("-f", "--file", help="书单文件，每行一个或多个小说ID")
+    parser.add_argument("-c", "--concurrency", type=int, default=app.CONFIG["batch"]["concurrency"],
+                        help="同时进入调度队列的书籍数，同时下载的数量受 scheduler.max_active_jobs 限制")
+    parser.add_argument("--update", action="store_true", help="只下载已下载小说的新增章节")
+    parser.add_argument("--report", help="汇总报告的输出路径，默认写入 batch.report_dir")
+    parser.add_argument("--export", choices=sorted(app.EXPORT_FORMATS), help="下载完成后导出为 EPUB 或分章节 ZIP")
+    args = parser.parse_args()
+
+    book_ids = read_book_ids(args)
+    if not book_ids:
+        parser.error("请输入小说ID")
+    os.makedirs('downloads', exist_ok=True)
+
+    batch_id, task_ids = app.create_batch(book_ids, 'update' if args.update else 'full')
+    active = min(args.concurrency, app.CONFIG["scheduler"]["max_active_jobs"])
+    print(f"批次 {batch_id}：{len(task_ids)} 本，同时下载 {active} 本")
+    future = app.download_engine.submit(app.async_download_batch(batch_id, task_ids, max(1, args.concurrency)))
+    try:
+        report = future.result()
+    except KeyboardInterrupt:
+        # 停止后已完成的章节都记录在清单中，再次运行会继续下载
+        print("正在停止...")
+        for task_id in task_ids:
+            app.stop_download(task_id)
+        report = future.result()
+    finally:
+        app.download_engine.stop()
+        app.cpu_pool.shutdown()
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.export:
+        export_books(report, args.export)
+    print_report(report)
+    sys.exit(0 if report['completed'] == report['books'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+番茄小说下载器 - 本地模拟上游
+Copyright (C) 2024 fanqie-novel-downloader
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+模拟目录、书籍页面、registerkey、batch_full（与 FqCrypto 相同的 AES-CBC + gzip 编码）和备用正文接口，
+延迟分布、错误率和限流均可配置，供 benchmark.py e2e 使用，也可以单独运行：
+    python fake_upstream.py --port 8765 --latency 0.05 --error-rate 0.01 --throttle 50
+
+应用中对应的配置：official_api.base_url 和 web_base_url 指向 http://127.0.0.1:<port>，
+api_endpoints 为 http://127.0.0.1:<port>/content?item_id={chapter_id}。
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import math
+import os
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+DEFAULT_SETTINGS = {
+    "chapters": 1000,  # 每本书的章节数
+    "paragraphs": 60,  # 每章段落数
+    "latency": 0.05,  # 响应延迟的中位数（秒）
+    "latency_dist": "lognormal",  # fixed、exponential 或 lognormal
+    "sigma": 0.5,  # lognormal 的形状参数，越大长尾越重
+    "error_rate": 0.0,  # batch_full 和备用接口返回 503 的概率
+    "missing_rate": 0.0,  # batch_full 响应中缺少某章（需走备用接口）的概率，按章节固定
+    "throttle": 0.0,  # 每个接口每秒放行的请求数，超出返回 429，0 表示不限流
+    "seed": 1
+}
+
+# 章节ID = 书籍ID * CHAPTER_ID_BASE + 章节序号
+CHAPTER_ID_BASE = 1000000
+TEXT_CHARS = "他她说道我们你的了是在不有这一个来看着笑声音天地人心中大小上下前后"
+
+
+def encrypt(key: bytes, data: bytes) -> str:
+    """与 FqCrypto.decrypt 对应：base64(iv + AES-CBC(pkcs7(data)))"""
+    iv = os.urandom(16)
+    return base64.b64encode(iv + AES.new(key, AES.MODE_CBC, iv).encrypt(pad(data, 16))).decode()
+
+
+class FakeUpstream:
+    def __init__(self, settings: dict, register_key: str):
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self.grk = bytes.fromhex(register_key)
+        self.key = os.urandom(16)
+        self.rng = random.Random(self.settings["seed"])
+        self.counts = Counter()
+        self.buckets = {}  # 接口 -> (令牌数, 上次补充时间)
+        self.encoded = {}  # 章节ID -> 加密后的正文，同一章只编码一次
+
+    def chapter(self, chapter_id: str) -> tuple:
+        """按章节ID确定性地生成 (标题, 正文HTML)"""
+        index = int(chapter_id) % CHAPTER_ID_BASE
+        rng = random.Random(int(chapter_id))
+        paragraphs = "".join(
+            f'<p idx="{k}">　　' + "".join(rng.choice(TEXT_CHARS) for _ in range(rng.randint(20, 160))) + '</p>'
+            for k in range(self.settings["paragraphs"])
+        )
+        title = f"标题{index + 1}"
+        return title, f'<header><div class="muye-reader-title">{title}</div></header><article><p>第{index + 1}章 {title}</p>{paragraphs}</article><footer><a>下一章</a></footer>'
+
+    def missing(self, chapter_id: str) -> bool:
+        return random.Random(f"missing-{chapter_id}").random() < self.settings["missing_rate"]
+
+    async def delay(self):
+        median = self.settings["latency"]
+        dist = self.settings["latency_dist"]
+        if dist == "exponential":
+            seconds = self.rng.expovariate(1 / median) if median > 0 else 0
+        elif dist == "lognormal":
+            seconds = median * math.exp(self.settings["sigma"] * self.rng.gauss(0, 1))
+        else:
+            seconds = median
+        await asyncio.sleep(seconds)
+
+    def throttled(self, route: str) -> bool:
+        """每个接口一个令牌桶，桶容量为一秒的令牌"""
+        rate = self.settings["throttle"]
+        if not rate:
+            return False
+        now = time.monotonic()
+        tokens, refilled_at = self.buckets.get(route, (rate, now))
+        tokens = min(rate, tokens + (now - refilled_at) * rate)
+        if tokens < 1:
+            self.buckets[route] = (tokens, now)
+            self.counts["throttled"] += 1
+            return True
+        self.buckets[route] = (tokens - 1, now)
+        return False
+
+    def failed(self) -> bool:
+        if self.rng.random() < self.settings["error_rate"]:
+            self.counts["errors"] += 1
+            return True
+        return False
+
+    async def registerkey(self, request):
+        self.counts["registerkey"] += 1
+        await self.delay()
+        return web.json_response({"data": {"key": encrypt(self.grk, self.key)}})
+
+    async def batch_full(self, request):
+        self.counts["batch_full"] += 1
+        if self.throttled("batch_full"):
+            return web.Response(status=429)
+        if self.failed():
+            return web.Response(status=503)
+        await self.delay()
+        data = {}
+        for chapter_id in request.query["item_ids"].split(","):
+            if self.missing(chapter_id):
+                continue
+            if chapter_id not in self.encoded:
+                title, html = self.chapter(chapter_id)
+                self.encoded[chapter_id] = (title, encrypt(self.key, gzip.compress(html.encode("utf-8"))))
+            title, content = self.encoded[chapter_id]
+            data[chapter_id] = {"content": content, "title": f"第{int(chapter_id) % CHAPTER_ID_BASE + 1}章 {title}"}
+        return web.json_response({"data": data})
+
+    async def content(self, request):
+        self.counts["content"] += 1
+        if self.throttled("content"):
+            return web.Response(status=429)
+        if self.failed():
+            return web.Response(status=503)
+        await self.delay()
+        title, html = self.chapter(request.query["item_id"])
+        return web.json_response({"data": {"content": html, "title": title}})
+
+    async def directory(self, request):
+        self.counts["directory"] += 1
+        await self.delay()
+        book_id = int(request.query["bookId"])
+        ids = [str(book_id * CHAPTER_ID_BASE + i) for i in range(self.settings["chapters"])]
+        return web.json_response({"code": 0, "data": {"allItemIds": ids}})
+
+    async def page(self, request):
+        self.counts["page"] += 1
+        await self.delay()
+        book_id = request.match_info["book_id"]
+        return web.Response(text=(
+            f'<html><body><h1>测试书{book_id}</h1>'
+            '<div class="author-name"><span class="author-name-text">测试作者</span></div>'
+            '<div class="page-abstract-content"><p>用于性能测试的模拟书籍。</p></div></body></html>'
+        ), content_type="text/html")
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.counts, "cpu_seconds": time.process_time()})
+
+    def make_app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post("/reading/crypt/registerkey", self.registerkey)
+        application.router.add_get("/reading/reader/batch_full/v", self.batch_full)
+        application.router.add_get("/content", self.content)
+        application.router.add_get("/api/reader/directory/detail", self.directory)
+        application.router.add_get("/page/{book_id}", self.page)
+        application.router.add_get("/stats", self.stats)
+        return application
+
+
+def run(port: int, settings: dict, register_key: str):
+    """在当前进程中运行模拟上游，直到进程结束"""
+    web.run_app(FakeUpstream(settings, register_key).make_app(), host="127.0.0.1", port=port, print=None,
+                access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="番茄小说下载器的本地模拟上游")
+    parser.add_argument("--port", type=int, default=8765)
+    for name, value in DEFAULT_SETTINGS.items():
+        option = "--" + name.replace("_", "-")
+        if name == "latency_dist":
+            parser.add_argument(option, default=value, choices=["fixed", "exponential", "lognormal"])
+        else:
+            parser.add_argument(option, type=type(value), default=value)
+    args = parser.parse_args()
+
+    # registerkey 的加密密钥与应用内置的一致
+    import app
+    run(args.port, {name: getattr(args, name) for name in DEFAULT_SETTINGS}, app.grk())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app 在导入时按相对路径创建 logs、data 等目录，测试在临时目录中运行，不污染仓库
+os.chdir(tempfile.mkdtemp(prefix="fanqie-test-"))
+
+import pytest
+from aiohttp import web
+
+import app
+import fake_upstream
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """每个测试使用独立的下载目录和任务数据库"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, "task_store", app.TaskStore(str(tmp_path / "tasks.db")))
+    monkeypatch.setitem(app.CONFIG["chapter_cache"], "enabled", False)
+    # 完成后的压缩副本在后台生成，测试中切换目录时会找不到相对路径
+    monkeypatch.setitem(app.CONFIG["compression"], "encodings", [])
+    return tmp_path
+
+
+@pytest.fixture
+def upstream(workdir, monkeypatch):
+    """在下载引擎的事件循环上运行模拟上游，应用的接口地址都指向它；测试中可以修改 server.settings"""
+    server = fake_upstream.FakeUpstream({"chapters": 60, "paragraphs": 8, "latency": 0.005, "latency_dist": "fixed"},
+                                        app.grk())
+
+    async def start():
+        runner = web.AppRunner(server.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, runner.addresses[0][1]
+
+    runner, port = app.download_engine.run(start())
+    base_url = f"http://127.0.0.1:{port}"
+    monkeypatch.setitem(app.CONFIG, "web_base_url", base_url)
+    monkeypatch.setitem(app.CONFIG["official_api"], "base_url", base_url)
+    monkeypatch.setitem(app.CONFIG, "api_endpoints", [f"{base_url}/content?item_id={{chapter_id}}"])
+    # 每个模拟上游的正文密钥不同，丢弃之前测试缓存的密钥
+    app.register_key_manager.invalidate(app.register_key_manager._crypto)
+    server.base_url = base_url
+    yield server
+    app.download_engine.run(runner.cleanup())
@@ -0,0 +1,43 @@
+"""章节清理的黄金测试：官方接口和备用接口两条路径的输出必须与固定的期望结果逐字一致"""
+
+import base64
+import gzip
+import json
+import os
+
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+import app
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "clean_chapters.json")
+KEY = bytes(range(16))
+
+with open(FIXTURES, encoding="utf-8") as f:
+    CASES = json.load(f)
+
+
+def encrypt(html: str) -> str:
+    iv = bytes(16)
+    return base64.b64encode(iv + AES.new(KEY, AES.MODE_CBC, iv).encrypt(pad(gzip.compress(html.encode("utf-8")), 16))).decode()
+
+
+@pytest.mark.parametrize("case", [c for c in CASES if c["source"] == "official"], ids=lambda c: c["name"])
+def test_official_path(case):
+    data = {"1": {"content": encrypt(case["content"]), "title": case["title"]}}
+    title, content = app.decode_official_contents(data, KEY.hex())["1"]
+    assert title == case["expected_title"]
+    assert content.split("\n") == case["expected"]
+
+
+@pytest.mark.parametrize("case", [c for c in CASES if c["source"] == "fallback"], ids=lambda c: c["name"])
+def test_fallback_path(case):
+    title, content = app.clean_chapters({"1": (case["title"], case["content"])})["1"]
+    assert title == case["expected_title"]
+    assert content.split("\n") == case["expected"]
+
+
+def test_escaped_bracket_removed_after_tags():
+    # 标签去掉后才拼出的 < 也要删除，两遍替换不能合并
+    assert app.clean_chapter_content("<p>abc\\u003<b>c def</p>", None) == "    abc def"
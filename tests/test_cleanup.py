@@ -0,0 +1,65 @@
+import os
+import time
+
+import app
+
+DAY = 86400
+
+
+def make_task(task_id, age, status, attached_to=None, file_path=None):
+    app.task_store.create(task_id, "1", "full", "", None)
+    app.task_store.update(task_id, status=status, attached_to=attached_to, file_path=file_path)
+    app.task_store._conn().execute("UPDATE tasks SET created_at = ? WHERE task_id = ?", (time.time() - age, task_id))
+
+
+def cleanup(monkeypatch):
+    monkeypatch.setattr(app.task_store, "claim", lambda key, interval: True)
+    app.cleanup_old_tasks()
+
+
+def test_attached_task_expires_with_finished_job(workdir, monkeypatch):
+    make_task("job", 2 * DAY, "completed")
+    make_task("attached", 2 * DAY, "running", attached_to="job")
+    cleanup(monkeypatch)
+    assert app.task_store.get("job") is None
+    assert app.task_store.get("attached") is None
+
+
+def test_attached_task_with_missing_job_is_not_running(workdir):
+    make_task("attached", 60, "running", attached_to="gone")
+    view = app.get_task_view("attached")
+    assert view["status"] == "stopped"
+    assert view["file_path"] is None
+
+
+def test_recent_attachment_keeps_job_file(workdir, monkeypatch):
+    path = str(workdir / "book.txt")
+    open(path, "w").close()
+    make_task("job", 2 * DAY, "completed", file_path=path)
+    make_task("attached", 3600, "completed", attached_to="job")
+    cleanup(monkeypatch)
+    assert os.path.exists(path)
+    assert app.get_task_view("attached")["file_path"] == path
+
+
+def test_stopped_task_expires_after_last_update(workdir, monkeypatch):
+    path = str(workdir / "partial.txt")
+    open(path, "w").close()
+    make_task("idle", 2 * DAY, "stopped", file_path=path)
+    app.task_store._conn().execute("UPDATE tasks SET updated_at = ? WHERE task_id = 'idle'", (time.time() - 2 * DAY,))
+    make_task("recent", 2 * DAY, "stopped")
+    cleanup(monkeypatch)
+    assert app.task_store.get("idle") is None
+    assert not os.path.exists(path)
+    assert app.task_store.get("recent") is not None
+
+
+def test_expired_task_keeps_file_of_newer_download(workdir, monkeypatch):
+    path = str(workdir / "book.txt")
+    open(path, "w").close()
+    make_task("old", 2 * DAY, "stopped", file_path=path)
+    app.task_store._conn().execute("UPDATE tasks SET updated_at = ? WHERE task_id = 'old'", (time.time() - 2 * DAY,))
+    make_task("new", 60, "completed", file_path=path)
+    cleanup(monkeypatch)
+    assert app.task_store.get("old") is None
+    assert os.path.exists(path)
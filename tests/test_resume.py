@@ -0,0 +1,170 @@
+"""续传、崩溃恢复和更新模式的回归测试：中断后继续下载得到的文件必须与一次下载完成的文件逐字节一致"""
+
+import json
+import os
+import time
+
+import pytest
+
+import app
+
+BOOK_ID = "7"
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    # 每章都写出清单，分组小一些，便于在中途停止或截断
+    monkeypatch.setitem(app.CONFIG, "write_buffer_size", 1)
+    monkeypatch.setitem(app.CONFIG, "batch_size", 5)
+    monkeypatch.setitem(app.CONFIG, "max_workers", 3)
+
+
+def new_task(task_id: str, mode: str = "full") -> str:
+    app.task_store.create(task_id, BOOK_ID, mode, "")
+    app.task_store.update(task_id, status="running", owner=app.get_owner())
+    return task_id
+
+
+def download(task_id: str, update: bool = False) -> dict:
+    new_task(task_id, "update" if update else "full")
+    app.download_engine.run(app.async_download_novel(BOOK_ID, task_id, update=update), timeout=60)
+    return app.task_store.get(task_id)
+
+
+def resume(task_id: str) -> dict:
+    app.task_store.update(task_id, status="running", stop_requested=0)
+    app.download_engine.run(app.async_download_novel(BOOK_ID, task_id), timeout=60)
+    return app.task_store.get(task_id)
+
+
+def manifest_lines() -> list:
+    with open(app.get_manifest_file(BOOK_ID), encoding="utf-8") as f:
+        return f.read().splitlines(keepends=True)
+
+
+def reference(workdir) -> bytes:
+    """在另一个目录中一次下载完成同一本书，作为比较基准"""
+    cwd = os.getcwd()
+    os.makedirs(workdir / "reference")
+    os.chdir(workdir / "reference")
+    try:
+        task = download(f"reference-{time.time_ns()}")
+        assert task["status"] == "completed"
+        with open(task["file_path"], "rb") as f:
+            return f.read()
+    finally:
+        os.chdir(cwd)
+
+
+def assert_complete(task: dict, expected: bytes):
+    assert task["status"] == "completed"
+    with open(task["file_path"], "rb") as f:
+        assert f.read() == expected
+    manifest = app.load_manifest(BOOK_ID)
+    records = manifest["chapters"]
+    assert len(records) == 60
+    assert all(record["status"] == "ok" for record in records.values())
+    assert app.verify_manifest(task["file_path"], records).keys() == records.keys()
+    assert not os.path.exists(task["file_path"] + ".part")
+
+
+def test_stop_and_resume(upstream, workdir):
+    upstream.settings["latency"] = 0.05
+    task_id = new_task("t1")
+    future = app.download_engine.submit(app.async_download_novel(BOOK_ID, task_id))
+    deadline = time.monotonic() + 30
+    while not os.path.exists(app.get_manifest_file(BOOK_ID)) or len(manifest_lines()) < 15:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    app.task_store.update(task_id, stop_requested=1)
+    future.result(60)
+
+    stopped = app.task_store.get(task_id)
+    assert stopped["status"] == "stopped"
+    written = app.load_manifest(BOOK_ID)["chapters"]
+    assert 0 < len(written) < 60
+    # 停止时已到达的章节都写出并记录，空位留给续传
+    assert app.verify_manifest(app.load_manifest(BOOK_ID)["book"]["output_file"], written).keys() == written.keys()
+
+    upstream.settings["latency"] = 0.005
+    assert_complete(resume(task_id), reference(workdir))
+
+
+def test_failed_chapters_are_refetched_by_rebuilding(upstream, workdir, monkeypatch):
+    # 官方接口缺少部分章节且备用接口不可用，这些章节以失败占位写在文件中间
+    upstream.settings["missing_rate"] = 0.1
+    monkeypatch.setitem(app.CONFIG, "api_endpoints", [f"{upstream.base_url}/unavailable?item_id={{chapter_id}}"])
+    monkeypatch.setitem(app.CONFIG["fallback"], "hedge", False)
+    task = download("t1")
+    failed = [r for r in app.load_manifest(BOOK_ID)["chapters"].values() if r["status"] == "failed"]
+    assert task["status"] == "completed" and task["failed_chapters"] == len(failed) > 0
+    assert min(r["index"] for r in failed) < 59
+
+    # 备用接口恢复后继续下载：失败章节之后的已完成章节从旧文件复制到 .part 中重建
+    monkeypatch.setitem(app.CONFIG, "api_endpoints", [f"{upstream.base_url}/content?item_id={{chapter_id}}"])
+    requests_before = upstream.counts["content"]
+    task = resume("t1")
+    assert task["write_manifest"].endswith(".part")
+    assert upstream.counts["content"] - requests_before == len(failed)
+    upstream.settings["missing_rate"] = 0.0
+    assert_complete(task, reference(workdir))
+
+
+def test_crash_with_torn_manifest_line_and_unrecorded_tail(upstream, workdir):
+    task = download("t1")
+    output_file = task["file_path"]
+    lines = manifest_lines()
+    record = json.loads(lines[31])
+
+    # 模拟崩溃：第 31 条记录只写了一半，正文写到了下一章的中间
+    with open(app.get_manifest_file(BOOK_ID), "w", encoding="utf-8") as f:
+        f.writelines(lines[:31])
+        f.write(lines[31][:len(lines[31]) // 2])
+    os.truncate(output_file, record["offset"] + record["length"] // 2)
+
+    assert len(app.load_manifest(BOOK_ID)["chapters"]) == 30
+    requests_before = upstream.counts["batch_full"]
+    task = resume("t1")
+    # 截掉未记录的尾部后原地追加，只重新下载清单之后的 30 章
+    assert not task["write_manifest"].endswith(".part")
+    assert upstream.counts["batch_full"] - requests_before == 6
+    assert_complete(task, reference(workdir))
+
+
+def test_corrupted_middle_chapter_is_rebuilt(upstream, workdir):
+    task = download("t1")
+    output_file = task["file_path"]
+    record = json.loads(manifest_lines()[11])
+    with open(output_file, "r+b") as f:
+        f.seek(record["offset"] + 4)
+        f.write(b"XXXX")
+
+    # 哈希不符的章节重新下载，其余章节从旧文件复制
+    requests_before = upstream.counts["batch_full"]
+    task = resume("t1")
+    assert task["write_manifest"].endswith(".part")
+    assert upstream.counts["batch_full"] - requests_before == 1
+    assert_complete(task, reference(workdir))
+
+
+def test_update_downloads_only_new_chapters(upstream, workdir):
+    upstream.settings["chapters"] = 45
+    task = download("t1")
+    assert task["status"] == "completed"
+
+    upstream.settings["chapters"] = 60
+    pages_before = upstream.counts["page"]
+    batches_before = upstream.counts["batch_full"]
+    task = download("t2", update=True)
+    assert task["new_chapters"] == 15
+    assert task["message"] == "更新完成，新增 15 章"
+    # 更新模式沿用清单中的书籍信息，只请求新增章节
+    assert upstream.counts["page"] == pages_before
+    assert upstream.counts["batch_full"] - batches_before == 3
+    assert_complete(task, reference(workdir))
+
+
+def test_update_without_previous_download_fails(upstream, workdir):
+    task = download("t1", update=True)
+    assert task["status"] == "error"
+    assert task["message"] == "未找到已下载的内容，请先完整下载该小说。"